@@ -13,11 +13,35 @@ config = {
     "SHEET": {
         "SPREADSHEET_ID": environ.get("SHEET__SPREADSHEET_ID"),
         "SPREADSHEET_GID": environ.get("SHEET__SPREADSHEET_GID"),
+        "STATE_PATH": environ.get("SHEET__STATE_PATH") or "db/sheet_state",
     },
     "MAPQUEST": {
-        "API_KEY": environ.get("MAPQUEST__API_KEY")
+        "API_KEY": environ.get("MAPQUEST__API_KEY"),
+        "CACHE_PATH": environ.get("MAPQUEST__CACHE_PATH") or "db/geocode_cache",
+        "CACHE_TTL_DAYS": float(environ.get("MAPQUEST__CACHE_TTL_DAYS") or 180),
+        "LOCALITIES_PATH": environ.get("MAPQUEST__LOCALITIES_PATH") or "geocodes.csv",
+        "REQUESTS_PER_MINUTE": float(environ.get("MAPQUEST__REQUESTS_PER_MINUTE") or 60),
+        "MAX_IN_FLIGHT": int(environ.get("MAPQUEST__MAX_IN_FLIGHT") or 4),
+        # locations per day, the free plan has 15000 a month
+        "DAILY_QUOTA": int(environ.get("MAPQUEST__DAILY_QUOTA") or 500)
+    },
+    "IMMOWEB": {
+        "REQUESTS_PER_MINUTE": float(environ.get("IMMOWEB__REQUESTS_PER_MINUTE") or 9),
+        "MAX_IN_FLIGHT": int(environ.get("IMMOWEB__MAX_IN_FLIGHT") or 2),
+        # the searches stop at the first page without anything new, except for a full sweep every that many hours
+        "FULL_SWEEP_HOURS": float(environ.get("IMMOWEB__FULL_SWEEP_HOURS") or 24),
+        "ARCHIVE_PATH": environ.get("IMMOWEB__ARCHIVE_PATH") or "db/page_archive",
+        "HTTP_CACHE_PATH": environ.get("IMMOWEB__HTTP_CACHE_PATH") or "db/http_cache",
+        "HTTP_CACHE_MB": float(environ.get("IMMOWEB__HTTP_CACHE_MB") or 100),
+        "RETRIES": int(environ.get("IMMOWEB__RETRIES") or 3),
+        "BACKOFF_SECONDS": float(environ.get("IMMOWEB__BACKOFF_SECONDS") or 10),
+        "SEARCHES_PATH": environ.get("IMMOWEB__SEARCHES_PATH")
     },
     "POIS": {
         "PATH": environ.get("POIS__PATH") or "pois.csv"
+    },
+    "SCORING": {
+        "PROFILE_PATH": environ.get("SCORING__PROFILE_PATH"),
+        "PROFILES_PATH": environ.get("SCORING__PROFILES_PATH")
     }
 }
@@ -0,0 +1,143 @@
+"""
+Scoring profile: the curves, feature bonuses and bedroom rules used to score a home.
+
+A profile is declared as JSON (see DEFAULT_PROFILE for the format) and compiled once into plain numpy
+evaluators, so scoring works the same on a single value or on a whole array of homes.
+
+On top of the default profile, named profiles can be declared (see load_profiles): they score the same homes
+with their own POIs, curves and weights, and are synced to their own sheet tab.
+"""
+import json
+from dataclasses import dataclass
+from functools import lru_cache
+from hashlib import sha1
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from localize_be.config import config
+
+DEFAULT_PROFILE = {
+    # "linear" is the least squares line through the anchor points,
+    # "piecewise" interpolates between them (and is flat past the last point)
+    "distance": {"fit": "linear", "points": [[0, 400], [10, 300], [14, 100], [16, 0]]},
+    "size": {"fit": "linear", "points": [[0, 0], [250, 250], [350, 270]]},
+    "bedrooms": {
+        # 4 rooms is pretty much a minimum, after that it's just a bonus
+        "fit": "linear",
+        "points": [[0, 0], [3, 0], [4, 100], [5, 120]],
+        # bedroom count to use when the ad does not say
+        "default": 3,
+        # an office counts as that many extra bedrooms
+        "office": 1
+    },
+    "features": {
+        "Attic": 15,
+        "Basement": 40,
+        "Garage": 30
+    },
+    # category => weight.  When set, the distance is the weighted average of the distance to the nearest POI of
+    # each of those categories, instead of the weighted average of the distance to all the POIs
+    "nearest": {}
+}
+
+
+@dataclass(frozen=True)
+class Curve:
+    """Score curve compiled from anchor points"""
+    xp: Tuple[float, ...]
+    fp: Tuple[float, ...]
+    slope: float = 0
+    intercept: float = 0
+    piecewise: bool = False
+
+    def __call__(self, x):
+        if self.piecewise:
+            return np.interp(x, self.xp, self.fp)
+        return np.multiply(x, self.slope) + self.intercept
+
+
+def compile_curve(spec: Dict) -> Curve:
+    points = np.array(spec["points"], dtype=float)
+    xp, fp = points[:, 0], points[:, 1]
+    fit = spec.get("fit", "linear")
+    if fit == "piecewise":
+        order = np.argsort(xp)
+        return Curve(xp=tuple(xp[order]), fp=tuple(fp[order]), piecewise=True)
+    if fit != "linear":
+        raise ValueError(f"Unknown curve fit: {fit}")
+    x_mean, y_mean = xp.mean(), fp.mean()
+    slope = np.sum((xp - x_mean) * (fp - y_mean)) / np.sum((xp - x_mean) ** 2)
+    return Curve(xp=tuple(xp), fp=tuple(fp), slope=float(slope), intercept=float(y_mean - slope * x_mean))
+
+
+@dataclass(frozen=True)
+class ScoringProfile:
+    distance: Curve
+    size: Curve
+    bedrooms: Curve
+    default_bedrooms: int
+    office_bedrooms: int
+    features: Dict[str, float]
+    nearest: Dict[str, float]
+    # hash of the profile declaration, changes whenever the scoring would change
+    version: str
+    name: str = "default"
+    # for the named profiles: path of the POI file and sheet tab (name and gid) the scores are synced to
+    pois_path: Optional[str] = None
+    sheet_tab: Optional[str] = None
+    sheet_gid: Optional[str] = None
+
+
+def compile_profile(spec: Dict, name: str = "default") -> ScoringProfile:
+    bedrooms = spec["bedrooms"]
+    sheet = spec.get("sheet") or {}
+    scoring_spec = {k: v for k, v in spec.items() if k != "sheet"}
+    return ScoringProfile(
+        distance=compile_curve(spec["distance"]),
+        size=compile_curve(spec["size"]),
+        bedrooms=compile_curve(bedrooms),
+        default_bedrooms=bedrooms.get("default", 3),
+        office_bedrooms=bedrooms.get("office", 1),
+        features=dict(spec.get("features", {})),
+        nearest=dict(spec.get("nearest", {})),
+        version=sha1(json.dumps(scoring_spec, sort_keys=True).encode()).hexdigest()[:12],
+        name=name,
+        pois_path=spec.get("pois"),
+        sheet_tab=sheet.get("tab"),
+        sheet_gid=sheet.get("gid")
+    )
+
+
+def load_profile(path: Optional[str] = None) -> ScoringProfile:
+    """
+    Load profile from a JSON file (the keys missing from it are taken from DEFAULT_PROFILE), or the default one
+    if no path is given
+    """
+    if not path:
+        return compile_profile(DEFAULT_PROFILE)
+    with open(path) as f:
+        return compile_profile(dict(DEFAULT_PROFILE, **json.load(f)))
+
+
+def load_profiles(path: Optional[str] = None) -> Dict[str, ScoringProfile]:
+    """
+    Load the named profiles from a JSON file holding name => profile.  On top of the keys of DEFAULT_PROFILE
+    (the missing ones are taken from it), each profile has "pois", the path of its POI file, and optionally
+    "sheet": {"tab": ..., "gid": ...} to sync its scores to another tab of the spreadsheet.
+    """
+    if not path:
+        return {}
+    with open(path) as f:
+        specs = json.load(f)
+    return {name: compile_profile(dict(DEFAULT_PROFILE, **spec), name) for name, spec in specs.items()}
+
+
+@lru_cache
+def get_scoring_profile() -> ScoringProfile:
+    return load_profile(config["SCORING"]["PROFILE_PATH"])
+
+
+@lru_cache
+def get_scoring_profiles() -> Dict[str, ScoringProfile]:
+    return load_profiles(config["SCORING"]["PROFILES_PATH"])
@@ -0,0 +1,61 @@
+"""
+What-if ranking of the cached homes: score them again with other POI weights or another scoring profile,
+reusing the distance matrix instead of going through the whole flow.
+"""
+from dataclasses import replace
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from localize_be.core.profile import ScoringProfile, get_scoring_profile
+from localize_be.core.scoring import min_by_category, nearest_block, poi_keys, score_block
+
+
+class HomeRanking:
+    def __init__(self, homes: List[Tuple[int, Dict]], pois: pd.DataFrame, distances: np.array):
+        """
+        :param homes: list of (id, details)
+        :param pois: POIs, in the same order as the distances columns
+        :param distances: distance matrix (homes x POIs)
+        """
+        self.ids = [id_ for id_, _ in homes]
+        self.homes = [details for _, details in homes]
+        self.pois = pois.reset_index(drop=True)
+        self.distances = distances
+
+    @classmethod
+    def from_cache(cls, cache, pois: pd.DataFrame) -> "HomeRanking":
+        """
+        Load the geocoded homes and their distances from the home cache
+        """
+        homes = cache.get_homes_geocoded()
+        return cls(homes, pois, cache.get_distances(homes, pois))
+
+    def rank(self, weights: Dict[str, float] = None, profile: ScoringProfile = None) -> pd.DataFrame:
+        """
+        Score the homes and return them sorted by descending total score
+
+        :param weights: new POI weights, by category or by POI key (see scoring.poi_keys), the weights
+            of the POIs not listed are left unchanged.  If the profile scores the nearest POI of each category,
+            the weights are by category.
+        :param profile: scoring profile to use instead of the configured one
+        """
+        profile = profile or get_scoring_profile()
+        if profile.nearest:
+            if weights:
+                profile = replace(profile, nearest={c: weights.get(c, w) for c, w in profile.nearest.items()})
+            scores = score_block(self.homes, *nearest_block(min_by_category(self.distances, self.pois), profile),
+                                 profile)
+            return self._ranked(scores)
+        poi_weights = self.pois.Weight.to_numpy(dtype=float)
+        if weights:
+            poi_weights = np.array([
+                weights.get(key, weights.get(category, weight))
+                for key, category, weight in zip(poi_keys(self.pois), self.pois.Category, poi_weights)
+            ], dtype=float)
+        return self._ranked(score_block(self.homes, self.distances, poi_weights, profile))
+
+    def _ranked(self, scores: Dict[str, np.array]) -> pd.DataFrame:
+        df = pd.DataFrame(scores, index=pd.Index(self.ids, name="id"))
+        return df.sort_values("TotalScore", ascending=False)
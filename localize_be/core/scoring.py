@@ -1,32 +1,16 @@
-from functools import lru_cache
+import json
+from hashlib import sha1
 from math import cos, radians
-from typing import Dict
+from typing import Dict, List, Tuple
 
 import numpy as np
 import pandas as pd
-from sklearn.linear_model import LinearRegression
 
+from localize_be.core.profile import ScoringProfile, get_scoring_profile
+from localize_be.core.spatial import PoiIndex, haversine
 
-@lru_cache
-def _distance_score_predictor():
-    reg = LinearRegression()
-    reg.fit(np.array([0, 10, 14, 16]).reshape(-1, 1), [400, 300, 100, 0])
-    return reg
-
-
-@lru_cache
-def _size_score_predictor():
-    reg = LinearRegression()
-    reg.fit(np.array([0, 250, 350]).reshape(-1, 1), [0, 250, 270])
-    return reg
-
-
-@lru_cache
-def _bedroom_score_predictor():
-    reg = LinearRegression()
-    # 4 rooms is pretty much a minimum, after that it's just a bonus
-    reg.fit(np.array([0, 3, 4, 5]).reshape(-1, 1), [0, 0, 100, 120])
-    return reg
+# details fields used for the score (on top of the profile features)
+SCORE_INPUTS = ("Lat", "Lng", "SqMeter", "Bedrooms", "Office")
 
 
 def _distance_pois(d: Dict, pois: pd.DataFrame) -> np.array:
@@ -42,30 +26,170 @@ def _distance_pois(d: Dict, pois: pd.DataFrame) -> np.array:
     return distances
 
 
+def poi_keys(pois: pd.DataFrame) -> List[str]:
+    """
+    Identity of each POI, used as key for the cached distances
+    """
+    if "Address" in pois.columns:
+        return [f"{c}|{a}" for c, a in zip(pois.Category, pois.Address)]
+    return [f"{c}|{lat},{lng}" for c, lat, lng in zip(pois.Category, pois.Lat, pois.Lng)]
+
+
+def score_fields(details: Dict) -> Dict:
+    """
+    The fields of the details that are set by the scoring
+    """
+    return {k: v for k, v in details.items() if _is_score_field(k)}
+
+
+def without_scores(details: Dict) -> Dict:
+    """
+    Copy of the details without the fields set by the scoring
+    """
+    return {k: v for k, v in details.items() if not _is_score_field(k)}
+
+
+def _is_score_field(name: str) -> bool:
+    return name.startswith("dist.") or name.endswith("Score")
+
+
+def pois_version(pois: pd.DataFrame) -> str:
+    """
+    Hash of the POI set, changes when a POI is added, removed, moved or re-weighted
+    """
+    values = list(zip(poi_keys(pois), pois.Lat.astype(float), pois.Lng.astype(float), pois.Weight.astype(float)))
+    return sha1(json.dumps(values).encode()).hexdigest()[:12]
+
+
+def score_fingerprint(details: Dict, pois_ver: str, profile: ScoringProfile = None) -> str:
+    """
+    Hash of everything the score of a home depends on: if it did not change, neither did the score
+    """
+    profile = profile or get_scoring_profile()
+    inputs = {f: details.get(f) for f in SCORE_INPUTS + tuple(profile.features)}
+    return sha1(json.dumps([inputs, pois_ver, profile.version], sort_keys=True).encode()).hexdigest()
+
+
+def distance_matrix(lat: np.array, lng: np.array, pois: pd.DataFrame) -> np.array:
+    """
+    Haversine distance between each home (rows) and each POI (columns)
+    """
+    return haversine(lat[:, np.newaxis], lng[:, np.newaxis],
+                     pois.Lat.to_numpy(dtype=float)[np.newaxis, :], pois.Lng.to_numpy(dtype=float)[np.newaxis, :])
+
+
+def min_by_category(distances: np.array, pois: pd.DataFrame) -> Dict[str, np.array]:
+    """
+    Distance to the nearest POI of each category, from the distance matrix (homes x POIs)
+    """
+    categories = pois.Category.to_numpy()
+    return {category: distances[:, categories == category].min(axis=1) for category in pd.unique(categories)}
+
+
+def nearest_block(nearest: Dict[str, np.array], profile: ScoringProfile) -> Tuple[np.array, np.array]:
+    """
+    Distances to the nearest POI of the categories listed in the profile (homes x categories) and their weights
+    """
+    missing = set(profile.nearest) - set(nearest)
+    if missing:
+        raise ValueError(f"No POI for categories: {', '.join(missing)}")
+    return (np.column_stack([nearest[category] for category in profile.nearest]),
+            np.array(list(profile.nearest.values()), dtype=float))
+
+
 def _distance_average(distances: np.array, pois: pd.DataFrame):
     # distances = np.sqrt((d["Lat"] - pois.Lat) ** 2 + (d["Lng"] - pois.Lng) ** 2)
     return np.sum(distances * pois.Weight) / np.sum(pois.Weight)
 
 
-def calculate_score(details: Dict, pois: pd.DataFrame):
+def calculate_score(details: Dict, pois: pd.DataFrame, profile: ScoringProfile = None):
     """
     Complete details with score fields
     """
+    profile = profile or get_scoring_profile()
     distances = _distance_pois(details, pois)
     for i, h in pois.iterrows():
         details[f"dist.{h['Category']}"] = distances[i]
-    details["dist.Total"] = _distance_average(distances, pois)
-    details["dist.Score"] = _distance_score_predictor().predict([[details["dist.Total"]]])[0]
-    details["size.Score"] = _size_score_predictor().predict([[details["SqMeter"]]])[0] if details["SqMeter"] else 0
-    bedrooms = details["Bedrooms"] or 3
+    nearest = distances.groupby(pois.Category).min()
+    for category, distance in nearest.items():
+        details[f"dist.min.{category}"] = distance
+    if profile.nearest:
+        block, weights = nearest_block({c: np.array([d]) for c, d in nearest.items()}, profile)
+        details["dist.Total"] = np.sum(block[0] * weights) / np.sum(weights)
+    else:
+        details["dist.Total"] = _distance_average(distances, pois)
+    details["dist.Score"] = profile.distance(details["dist.Total"])
+    details["size.Score"] = profile.size(details["SqMeter"]) if details["SqMeter"] else 0
+    bedrooms = details["Bedrooms"] or profile.default_bedrooms
     if details["Office"] == "Yes":
-        bedrooms += 1
-    bedroom_score = _bedroom_score_predictor().predict([[bedrooms]])[0]
-    features = {
-        "Attic": 15,
-        "Basement": 40,
-        "Garage": 30
-    }
-    feat_score = sum([w for n, w in features.items() if details[n] == "Yes"])
+        bedrooms += profile.office_bedrooms
+    bedroom_score = profile.bedrooms(bedrooms)
+    feat_score = sum([w for n, w in profile.features.items() if details[n] == "Yes"])
     details["TotalScore"] = feat_score + bedroom_score + details["size.Score"] + details["dist.Score"]
     return details
+
+
+def score_block(homes: List[Dict], distances: np.array, weights: np.array,
+                profile: ScoringProfile = None) -> Dict[str, np.array]:
+    """
+    Compute the score fields for a block of homes, given their distance to each POI (homes x POIs) and the
+    POI weights
+
+    :returns: a dictionary of score field => array with one value per home
+    """
+    profile = profile or get_scoring_profile()
+    dist_total = distances @ weights / np.sum(weights)
+    dist_score = profile.distance(dist_total)
+    sq_meters = np.array([d["SqMeter"] or 0 for d in homes], dtype=float)
+    size_score = np.where(sq_meters != 0, profile.size(sq_meters), 0)
+    bedrooms = np.array([(d["Bedrooms"] or profile.default_bedrooms) +
+                         (profile.office_bedrooms if d["Office"] == "Yes" else 0)
+                         for d in homes], dtype=float)
+    bedroom_score = profile.bedrooms(bedrooms)
+    feat_score = np.array([sum([w for n, w in profile.features.items() if d[n] == "Yes"]) for d in homes],
+                          dtype=float)
+    return {
+        "dist.Total": dist_total,
+        "dist.Score": dist_score,
+        "size.Score": size_score,
+        "TotalScore": feat_score + bedroom_score + size_score + dist_score
+    }
+
+
+def calculate_scores(homes: List[Dict], pois: pd.DataFrame, profile: ScoringProfile = None,
+                     distances: np.array = None) -> List[Dict]:
+    """
+    Batch version of calculate_score: complete the details of all homes with score fields, computing the
+    distances and sub-scores for the whole block of homes at once
+
+    When the profile scores the distance to the nearest POI of each category, the POIs are looked up in a
+    spatial index instead of computing the whole distance matrix.
+
+    :param distances: distance matrix (homes x POIs), computed if not passed
+    """
+    if not homes:
+        return homes
+    profile = profile or get_scoring_profile()
+    lat = np.array([d["Lat"] for d in homes], dtype=float)
+    lng = np.array([d["Lng"] for d in homes], dtype=float)
+    # when several POIs share a category, the last one wins (same as calculate_score)
+    last_poi = {category: j for j, category in enumerate(pois.Category)}
+    if profile.nearest:
+        nearest = PoiIndex(pois).nearest_by_category(lat, lng)
+        scores = score_block(homes, *nearest_block(nearest, profile), profile)
+        # only the distances to the last POI of each category are needed, not the whole matrix
+        last_distances = distance_matrix(lat, lng, pois.iloc[list(last_poi.values())])
+        fields = {f"dist.{category}": last_distances[:, i] for i, category in enumerate(last_poi)}
+    else:
+        if distances is None:
+            distances = distance_matrix(lat, lng, pois)
+        nearest = min_by_category(distances, pois)
+        scores = score_block(homes, distances, pois.Weight.to_numpy(dtype=float), profile)
+        fields = {f"dist.{category}": distances[:, j] for category, j in last_poi.items()}
+    fields.update({f"dist.min.{category}": distance for category, distance in nearest.items()})
+    fields.update(scores)
+    fields = {field: values.tolist() for field, values in fields.items()}
+    for i, details in enumerate(homes):
+        for field, values in fields.items():
+            details[field] = values[i]
+    return homes
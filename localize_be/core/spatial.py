@@ -0,0 +1,111 @@
+"""
+Spatial index of the POIs, to find the nearest POIs of each category without computing the distance to every
+POI of the catalogue.
+"""
+from typing import Dict, Tuple
+
+import numpy as np
+import pandas as pd
+
+EARTH_RADIUS = 6373.0
+KM_PER_DEGREE = EARTH_RADIUS * np.pi / 180
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """Distance in km between points given in degrees (broadcasting like numpy does)"""
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return EARTH_RADIUS * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+class _Grid:
+    """POIs of one category, bucketed in cells of cell_deg x cell_deg degrees"""
+
+    def __init__(self, lat: np.array, lng: np.array, positions: np.array, cell_deg: float):
+        self.lat, self.lng, self.positions = lat, lng, positions
+        self.cell_deg = cell_deg
+        cells_lat = np.floor(lat / cell_deg).astype(int)
+        cells_lng = np.floor(lng / cell_deg).astype(int)
+        self.cells = {}
+        for i, cell in enumerate(zip(cells_lat, cells_lng)):
+            self.cells.setdefault(cell, []).append(i)
+        self.cells = {cell: np.array(members) for cell, members in self.cells.items()}
+        self.bounds = cells_lat.min(), cells_lat.max(), cells_lng.min(), cells_lng.max()
+
+    def _ring(self, cell_lat: int, cell_lng: int, r: int) -> np.array:
+        """POIs in the cells at distance r (in cells) of the given cell"""
+        if r == 0:
+            cells = [(cell_lat, cell_lng)]
+        else:
+            cells = [(cell_lat + d_lat, cell_lng + d_lng)
+                     for d_lat in range(-r, r + 1)
+                     for d_lng in ((-r, r) if abs(d_lat) != r else range(-r, r + 1))]
+        members = [self.cells[c] for c in cells if c in self.cells]
+        return np.concatenate(members) if members else np.empty(0, dtype=int)
+
+    def _outside_bound(self, lat: float, lng: float, r: int) -> float:
+        """Lower bound of the distance between the point and any POI outside of the first r rings"""
+        cell_lat, cell_lng = np.floor(lat / self.cell_deg), np.floor(lng / self.cell_deg)
+        lat_gap = min(lat - (cell_lat - r) * self.cell_deg, (cell_lat + r + 1) * self.cell_deg - lat)
+        lng_gap = min(lng - (cell_lng - r) * self.cell_deg, (cell_lng + r + 1) * self.cell_deg - lng)
+        # POIs off in longitude are within the rings latitudes, use the one furthest from the equator
+        max_lat = np.radians(min(90.0, abs(lat) + (r + 1) * self.cell_deg))
+        lng_bound = 2 * EARTH_RADIUS * np.arcsin(min(1.0, np.cos(max_lat) * np.sin(np.radians(lng_gap) / 2)))
+        return min(lat_gap * KM_PER_DEGREE, lng_bound)
+
+    def nearest(self, lat: float, lng: float, k: int) -> Tuple[np.array, np.array]:
+        cell_lat, cell_lng = int(np.floor(lat / self.cell_deg)), int(np.floor(lng / self.cell_deg))
+        candidates = np.empty(0, dtype=int)
+        distances = np.empty(0)
+        # beyond that many rings, all the POIs have been visited
+        lat_lo, lat_hi, lng_lo, lng_hi = self.bounds
+        max_ring = max(abs(cell_lat - lat_lo), abs(cell_lat - lat_hi), abs(cell_lng - lng_lo), abs(cell_lng - lng_hi))
+        for r in range(max_ring + 1):
+            ring = self._ring(cell_lat, cell_lng, r)
+            if len(ring):
+                candidates = np.concatenate([candidates, ring])
+                distances = np.concatenate([distances, haversine(lat, lng, self.lat[ring], self.lng[ring])])
+                if len(candidates) > k:
+                    best = np.argpartition(distances, k - 1)[:k]
+                    candidates, distances = candidates[best], distances[best]
+            if len(candidates) >= k and distances.max() <= self._outside_bound(lat, lng, r):
+                break
+        order = np.argsort(distances)
+        return distances[order], self.positions[candidates[order]]
+
+
+class PoiIndex:
+    def __init__(self, pois: pd.DataFrame, cell_km: float = 5):
+        """
+        :param pois: POIs with Category, Lat and Lng
+        :param cell_km: size of the grid cells, ideally about the distance to the nearest POI of a category
+        """
+        cell_deg = cell_km / KM_PER_DEGREE
+        lat = pois.Lat.to_numpy(dtype=float)
+        lng = pois.Lng.to_numpy(dtype=float)
+        categories = pois.Category.to_numpy()
+        self.grids = {}
+        for category in pd.unique(categories):
+            positions = np.flatnonzero(categories == category)
+            self.grids[category] = _Grid(lat[positions], lng[positions], positions, cell_deg)
+
+    def nearest(self, lat: np.array, lng: np.array, category: str, k: int = 1) -> Tuple[np.array, np.array]:
+        """
+        Find the k nearest POIs of the category for each of the points
+
+        :returns: a tuple with the distances and the POIs positions in the frame (both points x k), padded with
+            inf and -1 if the category has less than k POIs
+        """
+        grid = self.grids[category]
+        distances = np.full((len(lat), k), np.inf)
+        positions = np.full((len(lat), k), -1)
+        for i, (point_lat, point_lng) in enumerate(zip(lat, lng)):
+            d, p = grid.nearest(point_lat, point_lng, k)
+            distances[i, :len(d)], positions[i, :len(p)] = d, p
+        return distances, positions
+
+    def nearest_by_category(self, lat: np.array, lng: np.array) -> Dict[str, np.array]:
+        """
+        Distance to the nearest POI of each category, for each of the points
+        """
+        return {category: self.nearest(lat, lng, category)[0][:, 0] for category in self.grids}
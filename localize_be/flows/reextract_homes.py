@@ -0,0 +1,10 @@
+from prefect import Flow
+from prefect.tasks.prefect import create_flow_run
+
+from localize_be.tasks.collect_homes import reextract_homes
+
+with Flow("Reextract Homes") as flow:
+    reextract = reextract_homes()
+    flow_run = create_flow_run(flow_name="Rescore Homes",
+                               project_name="localize-be")
+    flow.add_edge(reextract, flow_run)
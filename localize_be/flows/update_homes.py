@@ -8,8 +8,16 @@ with Flow("Update Homes") as flow:
     geocoding = geocode.geocode_homes()
     flow.add_edge(scraping, geocoding)
     pois = get_pois.get_pois()
-    scoring = score_homes.score_all(pois)
+    profile_pois = get_pois.get_profile_pois()
+    scoring = score_homes.score_all(pois, profile_pois=profile_pois)
     flow.add_edge(geocoding, scoring)
-    sync_new = sync.sync_new()
+    # the homes no longer listed are hidden in the same batch as the sync of each tab
+    old_homes = collect_homes.get_old_homes(search)
+    sync_new = sync.sync_new(old_homes)
     flow.add_edge(scoring, sync_new)
-    sync.filter_old(collect_homes.get_old_homes(search))
+    sync_profiles = sync.sync_profiles(old_homes)
+    flow.add_edge(scoring, sync_profiles)
+    # the crawl is resumed by the next run unless the whole flow succeeded
+    finish = collect_homes.finish_crawl(search)
+    for task in [sync_new, sync_profiles]:
+        flow.add_edge(task, finish)
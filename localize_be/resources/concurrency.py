@@ -0,0 +1,88 @@
+"""
+Helpers to call the remote services concurrently while staying polite
+"""
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Iterable, Iterator, Tuple, TypeVar, Union
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class RateLimiter:
+    """
+    Space out the calls to stay under a number of calls per minute, across all the threads sharing the limiter
+    """
+
+    def __init__(self, per_minute: float, jitter: float = 0.5):
+        """
+        :param per_minute: maximum number of calls per minute, 0 for no limit
+        :param jitter: randomize the interval between calls by that fraction, so they don't come like clockwork
+        """
+        self.interval = 60 / per_minute if per_minute else 0
+        self.jitter = jitter
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until the next call is allowed"""
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+        time.sleep(start - now)
+
+
+def map_concurrently(fn: Callable[[T], R], items: Iterable[T],
+                     max_in_flight: int) -> Iterator[Tuple[T, Union[R, Exception]]]:
+    """
+    Call fn on each item from a pool of max_in_flight threads, and yield (item, result) as the calls complete,
+    so the caller can process a result while the next calls are waiting on the network.
+    If a call raises, the exception is yielded in place of the result.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, max_in_flight)) as executor:
+        futures = {executor.submit(fn, item): item for item in items}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result()
+            except Exception as e:
+                yield futures[future], e
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Fail fast when a service keeps failing: after max_failures consecutive failures the calls are refused for
+    cooldown seconds, then they are let through again until the next failure
+    """
+
+    def __init__(self, max_failures: int, cooldown: float):
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self._failures = 0
+        self._open_until = 0.0
+        self._lock = threading.Lock()
+
+    def check(self):
+        """Raise CircuitOpenError if the calls are refused"""
+        with self._lock:
+            remaining = self._open_until - time.monotonic()
+        if remaining > 0:
+            raise CircuitOpenError(f"Too many failures, calls refused for {remaining:.0f} s")
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.max_failures:
+                self._open_until = time.monotonic() + self.cooldown
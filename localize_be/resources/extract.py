@@ -0,0 +1,110 @@
+"""
+Extraction of the JSON payloads from the Immoweb pages.
+
+The data we need is in a JSON: the window.classified script for a home, the :results attribute of the
+iw-search element for a search.  The fast extractor pulls it straight from the raw page, the soup extractor
+parses the whole document with BeautifulSoup, and the default one uses the fast path and falls back to the
+full parse when it fails.
+"""
+import html
+import json
+import re
+from abc import ABC, abstractmethod
+from typing import Dict, List, Union
+
+from bs4 import BeautifulSoup
+
+from localize_be.config import logger
+
+Content = Union[bytes, str]
+
+
+class ExtractionError(ValueError):
+    pass
+
+
+class Extractor(ABC):
+    @abstractmethod
+    def classified(self, content: Content) -> Dict:
+        """Get the home data (window.classified) from a home page"""
+
+    @abstractmethod
+    def search_results(self, content: Content) -> List[Dict]:
+        """Get the list of results from a search page"""
+
+
+class SoupExtractor(Extractor):
+    def classified(self, content: Content) -> Dict:
+        soup = BeautifulSoup(content, "html.parser")
+        data = soup.find('script', string=re.compile("^\\s*window.classified = "))
+        if not data:
+            raise ExtractionError("Could not find classified in document")
+        script_content = data.contents[0]
+        assert isinstance(script_content, str)
+        script_content = re.sub('^\\s*window.classified = ', '', script_content)
+        script_content = re.sub(';\\s*$', '', script_content)
+        return json.loads(script_content)
+
+    def search_results(self, content: Content) -> List[Dict]:
+        soup = BeautifulSoup(content, "html.parser")
+        search = soup.find('iw-search')
+        if not search or ':results' not in search.attrs:
+            raise ExtractionError("Could not find search results in document")
+        return json.loads(search.attrs[':results'])
+
+
+class FastExtractor(Extractor):
+    CLASSIFIED = re.compile(r"window\.classified = ")
+    SEARCH_RESULTS = re.compile(r"\s:results=(['\"])")
+    # the entities in the attribute, replaced without going through html.unescape when they are the only ones
+    ENTITIES = (("&quot;", '"'), ("&#39;", "'"), ("&lt;", "<"), ("&gt;", ">"), ("&amp;", "&"))
+
+    def classified(self, content: Content) -> Dict:
+        text = _text(content)
+        match = self.CLASSIFIED.search(text)
+        if not match:
+            raise ExtractionError("Could not find classified in document")
+        # the JSON ends where the decoder stops, no need to look for the end of the script
+        ad, _ = json.JSONDecoder().raw_decode(text, match.end())
+        return ad
+
+    def search_results(self, content: Content) -> List[Dict]:
+        text = _text(content)
+        start = text.find("<iw-search")
+        match = self.SEARCH_RESULTS.search(text, start) if start >= 0 else None
+        end = text.find(match.group(1), match.end()) if match else -1
+        if end < 0:
+            raise ExtractionError("Could not find search results in document")
+        return json.loads(self._unescape(text[match.end():end]))
+
+    def _unescape(self, value: str) -> str:
+        unescaped = value
+        for entity, char in self.ENTITIES[:-1]:
+            unescaped = unescaped.replace(entity, char)
+        if "&" in unescaped.replace("&amp;", ""):
+            return html.unescape(value)
+        return unescaped.replace("&amp;", "&")
+
+
+class FallbackExtractor(Extractor):
+    def __init__(self, fast: Extractor = None, full: Extractor = None):
+        self.fast = fast or FastExtractor()
+        self.full = full or SoupExtractor()
+
+    def classified(self, content: Content) -> Dict:
+        try:
+            return self.fast.classified(content)
+        except ValueError as e:
+            logger.debug(f"Fast extraction of classified failed, parsing the document: {e}")
+            return self.full.classified(content)
+
+    def search_results(self, content: Content) -> List[Dict]:
+        try:
+            return self.fast.search_results(content)
+        except ValueError as e:
+            logger.debug(f"Fast extraction of search results failed, parsing the document: {e}")
+            return self.full.search_results(content)
+
+
+def _text(content: Content) -> str:
+    return content.decode("utf-8", errors="replace") if isinstance(content, bytes) else content
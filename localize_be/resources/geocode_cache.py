@@ -0,0 +1,89 @@
+"""
+Persistent cache of the geocoded addresses
+"""
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from contextlib import closing
+from datetime import datetime, timezone
+from typing import Optional, Tuple
+
+from localize_be.config import config
+
+
+def normalize_address(address: str) -> str:
+    """Lower case, without accents nor punctuation, so that the spellings of an address share a cache entry"""
+    address = unicodedata.normalize("NFKD", address).encode("ascii", "ignore").decode()
+    return re.sub(r"[^a-z0-9]+", " ", address.lower()).strip()
+
+
+class GeocodeCache:
+    """
+    Normalized address => (lat, lng, quality), the entries older than ttl seconds are ignored.
+    Also keeps the number of locations sent to Mapquest each day, to stay under the quota.
+    Can be shared by threads.
+    """
+
+    def __init__(self, path, ttl):
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        with self._lock, closing(self.con.cursor()) as cur:
+            cur.execute("""
+            create table if not exists geocodes (
+                address text primary key, lat real, lng real, quality text, geocoded_at real
+            )
+            """)
+            cur.execute("create table if not exists usage (day text primary key, locations int)")
+            self.con.commit()
+
+    def close(self):
+        self.con.close()
+
+    def get(self, address: str) -> Optional[Tuple[float, float, str]]:
+        """Get (lat, lng, quality) of the address, None if it is not in the cache or expired"""
+        with self._lock, closing(self.con.cursor()) as cur:
+            cur.execute("select lat, lng, quality from geocodes where address=? and geocoded_at >= ?",
+                        (normalize_address(address), time.time() - self.ttl))
+            return cur.fetchone()
+
+    def put(self, address: str, lat, lng, quality=None):
+        with self._lock, closing(self.con.cursor()) as cur:
+            cur.execute("""
+            insert or replace into geocodes (address, lat, lng, quality, geocoded_at) values (?, ?, ?, ?, ?)
+            """, (normalize_address(address), lat, lng, quality, time.time()))
+            self.con.commit()
+
+    def reserve(self, locations: int, daily_quota: int) -> bool:
+        """
+        Count locations sent today (UTC), unless it would go over daily_quota (0 for no quota).
+        Returns whether they can be sent.
+        """
+        day = datetime.now(timezone.utc).date().isoformat()
+        with self._lock, closing(self.con.cursor()) as cur:
+            row = cur.execute("select locations from usage where day=?", (day,)).fetchone()
+            used = row[0] if row else 0
+            if daily_quota and used + locations > daily_quota:
+                return False
+            cur.execute("insert or replace into usage (day, locations) values (?, ?)", (day, used + locations))
+            self.con.commit()
+        return True
+
+    def release(self, locations: int):
+        """Give back locations reserved today that were not sent"""
+        day = datetime.now(timezone.utc).date().isoformat()
+        with self._lock, closing(self.con.cursor()) as cur:
+            cur.execute("update usage set locations=max(locations - ?, 0) where day=?", (locations, day))
+            self.con.commit()
+
+    def used_today(self) -> int:
+        day = datetime.now(timezone.utc).date().isoformat()
+        with self._lock, closing(self.con.cursor()) as cur:
+            row = cur.execute("select locations from usage where day=?", (day,)).fetchone()
+            return row[0] if row else 0
+
+
+def get_geocode_cache():
+    return GeocodeCache(config["MAPQUEST"]["CACHE_PATH"], config["MAPQUEST"]["CACHE_TTL_DAYS"] * 24 * 3600)
@@ -1,93 +1,585 @@
 import json
 import sqlite3
-from contextlib import closing
+import time
+from contextlib import closing, contextmanager
 from sqlite3 import Row
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
 
 from localize_be.config import config
+from localize_be.core.scoring import distance_matrix, poi_keys, without_scores
+
+
+def _initial_schema(cur):
+    cur.execute("""
+    create table if not exists homes (
+        id int primary key, city text, postal_code text, price int, 
+        property_type text, synced int default 0, geocoded int default 0, 
+        details text
+    )
+    """)
+    # caches created before the migrations were introduced may already have it
+    if "score_fingerprint" not in [row[1] for row in cur.execute("pragma table_info(homes)")]:
+        cur.execute("alter table homes add column score_fingerprint text")
+    # distance between each home and each POI, with the coordinates they were computed from
+    cur.execute("""
+    create table if not exists distances (
+        home_id int, poi text, home_lat real, home_lng real, poi_lat real, poi_lng real,
+        distance real, primary key (home_id, poi)
+    )
+    """)
+    # scores of the named scoring profiles (the default profile scores are in the home details)
+    cur.execute("""
+    create table if not exists profile_scores (
+        home_id int, profile text, scores text, score_fingerprint text, synced int default 0,
+        primary key (home_id, profile)
+    )
+    """)
+
+
+def _typed_columns(cur):
+    # fields of the details that are used in queries, kept in sync with the details on each write
+    cur.execute("alter table homes add column has_details int default 0")
+    cur.execute("alter table homes add column lat real")
+    cur.execute("alter table homes add column lng real")
+    cur.execute("alter table homes add column sq_meter int")
+    cur.execute("alter table homes add column bedrooms int")
+    cur.execute("alter table homes add column total_score real")
+    cur.execute(f"update homes set {_DETAILS_COLUMNS.format(details='details')}")
+    # the work queues, the queries must use the same conditions for the indexes to be used
+    cur.execute("create index homes_to_geocode on homes(id) where geocoded=0 and has_details=1")
+    cur.execute("create index homes_geocoded on homes(id) where geocoded=1 and has_details=1")
+    cur.execute("create index homes_to_sync on homes(id) where geocoded=1 and synced=0 and has_details=1")
+    cur.execute("create index homes_missing_details on homes(id) where has_details=0")
+    cur.execute("create index homes_synced on homes(id) where synced=1")
+    cur.execute("create index homes_total_score on homes(total_score)")
+    cur.execute("create index profile_scores_to_sync on profile_scores(profile, home_id) where synced=0")
+
+
+def _search_checkpoints(cur):
+    # newest listing seen by each search, and when all its pages were last fetched
+    cur.execute("""
+    create table search_checkpoints (
+        search text primary key, newest_id int, newest_price int, full_sweep_at real
+    )
+    """)
+
+
+def _price_history(cur):
+    # the prices of each home, a row is added each time the price changes
+    cur.execute("create table price_history (home_id int, price int, seen_at real)")
+    cur.execute("create index price_history_home on price_history(home_id, seen_at)")
+    cur.execute("insert into price_history (home_id, price) select id, price from homes where price is not null")
+
+
+def _crawl_journal(cur):
+    # progress of the searches, an unfinished crawl is resumed by the next run
+    cur.execute("create table crawls (id integer primary key, full_sweep int, started_at real, finished_at real)")
+    cur.execute("""
+    create table crawl_pages (crawl_id int, search text, page int, homes text, primary key (crawl_id, search, page))
+    """)
+    # listings whose details could not be fetched, not tried again before retry_after
+    cur.execute("""
+    create table fetch_failures (home_id int primary key, listing text, attempts int, retry_after real, error text)
+    """)
+
+
+def _geocode_failures(cur):
+    # homes that could not be geocoded, not tried again before retry_after
+    cur.execute("create table geocode_failures (home_id int primary key, attempts int, retry_after real, error text)")
+
+
+# record the price of a home (:id, :price, :seen_at) if it is not the last one recorded
+_RECORD_PRICE = """
+insert into price_history (home_id, price, seen_at)
+select :id, :price, :seen_at
+where :price is not (select price from price_history where home_id=:id order by seen_at desc, rowid desc limit 1)
+"""
+
+# set the typed columns from the details JSON (passed as the {details} expression)
+_DETAILS_COLUMNS = """
+    has_details=({details} <> '{{}}'),
+    lat=json_extract({details}, '$.Lat'),
+    lng=json_extract({details}, '$.Lng'),
+    sq_meter=json_extract({details}, '$.SqMeter'),
+    bedrooms=json_extract({details}, '$.Bedrooms'),
+    total_score=json_extract({details}, '$.TotalScore')
+"""
+
+# schema migrations, the index (+1) of the last one applied is saved in the user_version of the database
+MIGRATIONS = [
+    _initial_schema,
+    _typed_columns,
+    _search_checkpoints,
+    _price_history,
+    _crawl_journal,
+    _geocode_failures,
+]
 
 
 class HomeCache:
     def __init__(self, path):
         self.con = sqlite3.connect(path)
+        self._transaction_depth = 0
+        self._migrate()
+
+    def _migrate(self):
         with closing(self.con.cursor()) as cur:
-            cur.execute("""
-            create table if not exists homes (
-                id int primary key, city text, postal_code text, price int, 
-                property_type text, synced int default 0, geocoded int default 0, 
-                details text
-            )
-            """)
-            self.con.commit()
+            version = cur.execute("pragma user_version").fetchone()[0]
+            for i, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                cur.execute("begin")
+                migration(cur)
+                cur.execute(f"pragma user_version = {i}")
+                self.con.commit()
 
     def close(self):
         self.con.close()
 
+    @contextmanager
+    def transaction(self):
+        """
+        Group the writes done in the block in a single transaction, committed at the end of the outermost block
+        (or rolled back if it raises)
+        """
+        self._transaction_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._transaction_depth -= 1
+            if not self._transaction_depth:
+                self.con.rollback()
+            raise
+        self._transaction_depth -= 1
+        self._commit()
+
+    def _commit(self):
+        if not self._transaction_depth:
+            self.con.commit()
+
     def add_home(self, data, details, synced=False):
         """
         Add a home to the cache.  If it is already there, update the data and set the synced flag to 0.
         """
+        self.add_homes([(data, details)], synced)
+
+    def add_homes(self, homes: List[Tuple[Dict, Dict]], synced=False):
+        """
+        Add homes, given as a list of (data, details), see add_home
+        """
+        params = [dict(details=json.dumps(details), synced=1 if synced else 0, **data) for data, details in homes]
         with closing(self.con.cursor()) as cur:
-            cur.execute("""
+            cur.executemany("""
             insert into homes (id, property_type, city, postal_code, price, details, synced)
             values (:id, :property_type, :city, :postal_code, :price, :details, :synced) 
             on conflict(id) do update set price=excluded.price, 
                                           details=excluded.details, 
-                                          synced=:synced
-            """, dict(details=json.dumps(details),
-                      synced=1 if synced else 0,
-                      **data))
-            self.con.commit()
+                                          synced=:synced,
+                                          score_fingerprint=null
+            """, params)
+            cur.executemany(f"update homes set {_DETAILS_COLUMNS.format(details=':details')} where id=:id", params)
+            cur.executemany("update profile_scores set synced=0, score_fingerprint=null where home_id=?",
+                            [(data["id"],) for data, _ in homes])
+            seen_at = time.time()
+            cur.executemany(_RECORD_PRICE, [dict(id=data["id"], price=data["price"], seen_at=seen_at)
+                                            for data, _ in homes])
+            self._commit()
 
-    def update_home(self, id_, details):
-        """Update home details and set synced to 0"""
+    def update_prices(self, prices: List[Tuple[int, int]]):
+        """
+        Update the price of homes, given as a list of (id, price), without fetching their details again.
+        The homes are set to be rescored and synced.
+        """
+        params = [dict(id=id_, price=price, seen_at=time.time()) for id_, price in prices]
         with closing(self.con.cursor()) as cur:
-            cur.execute("update homes set synced=0, details=? where id=?", (json.dumps(details), id_))
-            self.con.commit()
+            cur.executemany("""
+            update homes set price=:price, synced=0, score_fingerprint=null,
+                             details=case when has_details then json_set(details, '$.Price', :price) else details end
+            where id=:id
+            """, params)
+            cur.executemany("update profile_scores set synced=0, score_fingerprint=null where home_id=?",
+                            [(id_,) for id_, _ in prices])
+            cur.executemany(_RECORD_PRICE, params)
+            self._commit()
+
+    def get_price_history(self, id_) -> List[Tuple[int, float]]:
+        """Get the prices of a home, oldest first, as (price, seen_at), seen_at is None if unknown"""
+        with closing(self.con.cursor()) as cur:
+            cur.execute("select price, seen_at from price_history where home_id=? order by seen_at, rowid", (id_,))
+            return cur.fetchall()
+
+    def classify_listings(self, listings: List[Dict]) -> Dict[str, List[Dict]]:
+        """
+        Compare search results (dicts with at least id and price) with the cache, in a single query
+
+        :returns: "new", "price_changed" and "unchanged" => listings, without duplicates
+        """
+        unique = {}
+        for listing in listings:
+            unique.setdefault(listing["id"], listing)
+        prices = self.get_prices(list(unique))
+        classified = {"new": [], "price_changed": [], "unchanged": []}
+        for listing in unique.values():
+            if listing["id"] not in prices:
+                classified["new"].append(listing)
+            elif prices[listing["id"]] != listing["price"]:
+                classified["price_changed"].append(listing)
+            else:
+                classified["unchanged"].append(listing)
+        return classified
+
+    def update_home(self, id_, details, score_fingerprint=None):
+        """Update home details and set synced to 0.  The score fingerprint is replaced (cleared if not given)"""
+        self.update_homes([(id_, details)], {id_: score_fingerprint})
+
+    def update_homes(self, homes: List[Tuple[int, Dict]], score_fingerprints: Dict[int, str] = None):
+        """
+        Update homes, given as a list of (id, details), see update_home
+
+        :param score_fingerprints: id => score fingerprint
+        """
+        score_fingerprints = score_fingerprints or {}
+        with closing(self.con.cursor()) as cur:
+            cur.executemany(f"""
+            update homes set synced=0, details=:details, score_fingerprint=:score_fingerprint,
+                             {_DETAILS_COLUMNS.format(details=':details')}
+            where id=:id
+            """, [dict(id=id_, details=json.dumps(details), score_fingerprint=score_fingerprints.get(id_))
+                  for id_, details in homes])
+            cur.executemany("update profile_scores set synced=0 where home_id=?", [(id_,) for id_, _ in homes])
+            self._commit()
+
+    def set_score_fingerprint(self, id_, score_fingerprint):
+        """Save the fingerprint of the score inputs, without touching the details or the synced flag"""
+        self.set_score_fingerprints({id_: score_fingerprint})
+
+    def set_score_fingerprints(self, score_fingerprints: Dict[int, str]):
+        with closing(self.con.cursor()) as cur:
+            cur.executemany("update homes set score_fingerprint=? where id=?",
+                            [(fingerprint, id_) for id_, fingerprint in score_fingerprints.items()])
+            self._commit()
+
+    def get_score_fingerprints(self, ids: List[int]) -> Dict[int, str]:
+        with closing(self.con.cursor()) as cur:
+            cur.execute("""
+            select id, score_fingerprint from homes
+            where id in (select value from json_each(?)) and score_fingerprint is not null
+            """, (json.dumps(ids),))
+            return dict(cur.fetchall())
 
     def set_synced(self, id_):
+        self.set_synced_many([id_])
+
+    def set_synced_many(self, ids: List[int]):
         with closing(self.con.cursor()) as cur:
-            cur.execute("update homes set synced=1 where id=?", (id_,))
-            self.con.commit()
+            cur.executemany("update homes set synced=1 where id=?", [(id_,) for id_ in ids])
+            self._commit()
 
     def set_geocoded(self, id_):
+        self.set_geocoded_many([id_])
+
+    def set_geocoded_many(self, ids: List[int]):
         with closing(self.con.cursor()) as cur:
-            cur.execute("update homes set geocoded=1 where id=?", (id_,))
-            self.con.commit()
+            cur.executemany("update homes set geocoded=1 where id=?", [(id_,) for id_ in ids])
+            self._commit()
+
+    def get_prices(self, ids: List[int]) -> Dict[int, int]:
+        """Get the price of the homes that are in the cache, as id => price"""
+        with closing(self.con.cursor()) as cur:
+            cur.execute("select id, price from homes where id in (select value from json_each(?))",
+                        (json.dumps(ids),))
+            return dict(cur.fetchall())
+
+    def get_search_checkpoint(self, search) -> Row:
+        """Get the checkpoint of a search (newest_id, newest_price, full_sweep_at), None if it never ran"""
+        with closing(self.con.cursor()) as cur:
+            cur.row_factory = Row
+            cur.execute("select newest_id, newest_price, full_sweep_at from search_checkpoints where search=?",
+                        (search,))
+            return cur.fetchone()
+
+    def set_search_checkpoint(self, search, newest_id, newest_price, full_sweep_at=None):
+        """Save the newest listing of a search, and the time of its last full sweep if it was one"""
+        with closing(self.con.cursor()) as cur:
+            cur.execute("""
+            insert into search_checkpoints (search, newest_id, newest_price, full_sweep_at) values (?, ?, ?, ?)
+            on conflict(search) do update set newest_id=excluded.newest_id, newest_price=excluded.newest_price,
+                                              full_sweep_at=coalesce(excluded.full_sweep_at, full_sweep_at)
+            """, (search, newest_id, newest_price, full_sweep_at))
+            self._commit()
+
+    def start_crawl(self, full_sweep: bool, max_age_seconds) -> "CrawlJournal":
+        """
+        Resume the last unfinished crawl if it started less than max_age_seconds ago (with its own full_sweep),
+        or start a new one, dropping the pages of the crawls that were abandoned
+        """
+        with closing(self.con.cursor()) as cur:
+            row = cur.execute("""
+            select id, full_sweep from crawls where finished_at is null and started_at >= ? order by id desc limit 1
+            """, (time.time() - max_age_seconds,)).fetchone()
+            if not row:
+                cur.execute("insert into crawls (full_sweep, started_at) values (?, ?)", (int(full_sweep), time.time()))
+                row = (cur.lastrowid, int(full_sweep))
+                cur.execute("delete from crawl_pages where crawl_id <> ?", (row[0],))
+                self._commit()
+        return CrawlJournal(self, row[0], bool(row[1]))
+
+    def finish_crawl(self, crawl_id):
+        with closing(self.con.cursor()) as cur:
+            cur.execute("update crawls set finished_at=? where id=?", (time.time(), crawl_id))
+            cur.execute("delete from crawl_pages where crawl_id=?", (crawl_id,))
+            self._commit()
+
+    def get_crawl_page(self, crawl_id, search, page) -> Optional[List[Dict]]:
+        with closing(self.con.cursor()) as cur:
+            row = cur.execute("select homes from crawl_pages where crawl_id=? and search=? and page=?",
+                              (crawl_id, search, page)).fetchone()
+            return json.loads(row[0]) if row else None
+
+    def set_crawl_page(self, crawl_id, search, page, homes: List[Dict]):
+        with closing(self.con.cursor()) as cur:
+            cur.execute("insert or replace into crawl_pages (crawl_id, search, page, homes) values (?, ?, ?, ?)",
+                        (crawl_id, search, page, json.dumps(homes)))
+            self._commit()
+
+    def add_fetch_failure(self, listing: Dict, error, backoff_seconds, max_backoff_seconds):
+        """
+        Record that the details of a listing could not be fetched, it is not tried again before
+        backoff_seconds, doubled at each attempt (up to max_backoff_seconds)
+        """
+        with closing(self.con.cursor()) as cur:
+            row = cur.execute("select attempts from fetch_failures where home_id=?", (listing["id"],)).fetchone()
+            attempts = (row[0] if row else 0) + 1
+            retry_after = time.time() + min(backoff_seconds * 2 ** (attempts - 1), max_backoff_seconds)
+            cur.execute("""
+            insert or replace into fetch_failures (home_id, listing, attempts, retry_after, error)
+            values (?, ?, ?, ?, ?)
+            """, (listing["id"], json.dumps(listing), attempts, retry_after, str(error)))
+            self._commit()
+
+    def clear_fetch_failures(self, ids: List[int]):
+        with closing(self.con.cursor()) as cur:
+            cur.executemany("delete from fetch_failures where home_id=?", [(id_,) for id_ in ids])
+            self._commit()
+
+    def get_fetch_failures(self) -> Tuple[List[Dict], List[int]]:
+        """Get the failed listings that can be tried again, and the ids of those that must wait"""
+        with closing(self.con.cursor()) as cur:
+            now = time.time()
+            due, waiting = [], []
+            for home_id, listing, retry_after in cur.execute(
+                    "select home_id, listing, retry_after from fetch_failures"):
+                if retry_after <= now:
+                    due.append(json.loads(listing))
+                else:
+                    waiting.append(home_id)
+            return due, waiting
+
+    def add_geocode_failures(self, failures: List[Tuple[int, str]], backoff_seconds, max_backoff_seconds):
+        """
+        Record that the homes (id, error) could not be geocoded, they are not tried again before backoff_seconds,
+        doubled at each attempt (up to max_backoff_seconds)
+        """
+        with closing(self.con.cursor()) as cur:
+            now = time.time()
+            attempts = dict(cur.execute(
+                "select home_id, attempts from geocode_failures where home_id in (select value from json_each(?))",
+                (json.dumps([id_ for id_, _ in failures]),)).fetchall())
+            rows = []
+            for id_, error in failures:
+                attempt = attempts.get(id_, 0) + 1
+                rows.append((id_, attempt, now + min(backoff_seconds * 2 ** (attempt - 1), max_backoff_seconds),
+                             str(error)))
+            cur.executemany("""
+            insert or replace into geocode_failures (home_id, attempts, retry_after, error) values (?, ?, ?, ?)
+            """, rows)
+            self._commit()
+
+    def clear_geocode_failures(self, ids: List[int]):
+        with closing(self.con.cursor()) as cur:
+            cur.executemany("delete from geocode_failures where home_id=?", [(id_,) for id_ in ids])
+            self._commit()
+
+    def get_geocode_waiting(self) -> List[int]:
+        """Get the ids of the homes that failed to geocode and must wait before being tried again"""
+        with closing(self.con.cursor()) as cur:
+            cur.execute("select home_id from geocode_failures where retry_after > ?", (time.time(),))
+            return [row[0] for row in cur.fetchall()]
 
     def has_home(self, id_, price):
+        """Whether the home is in the cache, whatever its price (see classify_listings to compare the prices)"""
         with closing(self.con.cursor()) as cur:
-            # TODO we should have some way to update the ones that have a modified price...
             cur.execute("select id from homes where id=?", (id_,))
             return cur.fetchall()
 
+    def _iter_rows(self, sql, params=(), chunk_size=500, row_factory=None) -> Iterator:
+        """
+        Run the query and stream its rows, fetching chunk_size rows at a time
+        """
+        with closing(self.con.cursor()) as cur:
+            cur.row_factory = row_factory
+            cur.execute(sql, params)
+            rows = cur.fetchmany(chunk_size)
+            while rows:
+                yield from rows
+                rows = cur.fetchmany(chunk_size)
+
+    def _iter_homes(self, where, chunk_size) -> Iterator[Tuple[int, Dict]]:
+        """
+        Stream the homes by id, chunk_size at a time.  Each chunk is a query of its own, from the last id of the
+        previous one, so the homes can be updated while they are streamed (SQLite does not tell whether a running
+        query sees the rows updated on the same connection)
+        """
+        last_id = float("-inf")
+        while True:
+            with closing(self.con.cursor()) as cur:
+                rows = cur.execute(f"select id, details from homes where ({where}) and id > ? order by id limit ?",
+                                   (last_id, chunk_size)).fetchall()
+            yield from ((id_, json.loads(details)) for id_, details in rows)
+            if len(rows) < chunk_size:
+                return
+            last_id = rows[-1][0]
+
+    def iter_homes_geocoded(self, chunk_size=500) -> Iterator[Tuple[int, Dict]]:
+        """Stream already geocoded homes (synced or not)"""
+        return self._iter_homes("geocoded=1 and has_details=1", chunk_size)
+
+    def iter_homes_to_sync(self, chunk_size=500) -> Iterator[Tuple[int, Dict]]:
+        return self._iter_homes("geocoded=1 and synced=0 and has_details=1", chunk_size)
+
+    def iter_homes_to_geocode(self, chunk_size=500) -> Iterator[Tuple[int, Dict]]:
+        return self._iter_homes("geocoded=0 and has_details=1", chunk_size)
+
+    def iter_homes_with_details(self, chunk_size=500) -> Iterator[Tuple[int, Dict]]:
+        return self._iter_homes("has_details=1", chunk_size)
+
+    def iter_homes_missing_details(self, chunk_size=500) -> Iterator[Row]:
+        return self._iter_rows("select id, property_type, postal_code, city from homes where has_details=0",
+                               chunk_size=chunk_size, row_factory=Row)
+
     def get_homes_geocoded(self):
         """Get already geocoded homes (synced or not)"""
-        with closing(self.con.cursor()) as cur:
-            cur.execute("select id, details from homes where geocoded=1 and details <> '{}'")
-            return [(row[0], json.loads(row[1])) for row in cur.fetchall()]
+        return list(self.iter_homes_geocoded())
 
     def get_homes_to_sync(self):
-        with closing(self.con.cursor()) as cur:
-            cur.execute("select id, details from homes where geocoded=1 and synced=0 and details <> '{}'")
-            return [(row[0], json.loads(row[1])) for row in cur.fetchall()]
+        return list(self.iter_homes_to_sync())
 
     def get_homes_to_geocode(self):
-        with closing(self.con.cursor()) as cur:
-            cur.execute("select id, details from homes where geocoded=0 and details <> '{}'")
-            return [(row[0], json.loads(row[1])) for row in cur.fetchall()]
+        return list(self.iter_homes_to_geocode())
 
     def get_homes_missing_details(self):
-        self.con.row_factory = Row
-        with closing(self.con.cursor()) as cur:
-            sql = "select id, property_type, postal_code, city from homes where details = '{}'"
-            cur.execute(sql)
-            return cur.fetchall()
+        return list(self.iter_homes_missing_details())
 
     def get_synced_ids(self):
         with closing(self.con.cursor()) as cur:
             cur.execute("select id from homes where synced=1")
             return [row[0] for row in cur.fetchall()]
 
+    def get_profile_scores(self, profile, ids: List[int]) -> Dict[int, Tuple[Dict, str]]:
+        """Get the scores of a named profile for the homes, as id => (scores, score fingerprint)"""
+        with closing(self.con.cursor()) as cur:
+            cur.execute("""
+            select home_id, scores, score_fingerprint from profile_scores
+            where profile=? and home_id in (select value from json_each(?))
+            """, (profile, json.dumps(ids)))
+            return {row[0]: (json.loads(row[1]), row[2]) for row in cur.fetchall()}
+
+    def set_profile_scores(self, id_, profile, scores, score_fingerprint):
+        """Save the scores of a named profile and set its synced flag to 0"""
+        with closing(self.con.cursor()) as cur:
+            cur.execute("""
+            insert into profile_scores (home_id, profile, scores, score_fingerprint, synced)
+            values (?, ?, ?, ?, 0)
+            on conflict(home_id, profile) do update set scores=excluded.scores,
+                                                        score_fingerprint=excluded.score_fingerprint,
+                                                        synced=0
+            """, (id_, profile, json.dumps(scores), score_fingerprint))
+            self._commit()
+
+    def set_profile_score_fingerprint(self, id_, profile, score_fingerprint):
+        with closing(self.con.cursor()) as cur:
+            cur.execute("update profile_scores set score_fingerprint=? where home_id=? and profile=?",
+                        (score_fingerprint, id_, profile))
+            self._commit()
+
+    def set_profile_synced(self, id_, profile):
+        with closing(self.con.cursor()) as cur:
+            cur.execute("update profile_scores set synced=1 where home_id=? and profile=?", (id_, profile))
+            self._commit()
+
+    def get_profile_homes_to_sync(self, profile):
+        """Get the homes with their details completed by the scores of the named profile"""
+        with closing(self.con.cursor()) as cur:
+            cur.execute("""
+            select h.id, h.details, s.scores from homes h join profile_scores s on s.home_id = h.id
+            where s.profile=? and s.synced=0 and h.geocoded=1 and h.has_details=1
+            """, (profile,))
+            return [(row[0], dict(without_scores(json.loads(row[1])), **json.loads(row[2])))
+                    for row in cur.fetchall()]
+
+    def get_distances(self, homes: List[Tuple[int, Dict]], pois: pd.DataFrame) -> np.array:
+        """
+        Get the matrix of distances between the homes (rows) and the POIs (columns).
+        Distances are read from the cache, only the pairs that are new or where the home or the POI has moved
+        are computed (and saved).
+        """
+        ids = [id_ for id_, _ in homes]
+        keys = poi_keys(pois)
+        home_lat = np.array([d["Lat"] for _, d in homes], dtype=float)
+        home_lng = np.array([d["Lng"] for _, d in homes], dtype=float)
+        poi_lat = pois.Lat.to_numpy(dtype=float)
+        poi_lng = pois.Lng.to_numpy(dtype=float)
+        rows = {id_: i for i, id_ in enumerate(ids)}
+        columns = {key: j for j, key in enumerate(keys)}
+        distances = np.full((len(ids), len(keys)), np.nan)
+        with closing(self.con.cursor()) as cur:
+            cur.execute("""
+            select home_id, poi, home_lat, home_lng, poi_lat, poi_lng, distance from distances
+            where home_id in (select value from json_each(?)) and poi in (select value from json_each(?))
+            """, (json.dumps(ids), json.dumps(keys)))
+            for home_id, poi, h_lat, h_lng, p_lat, p_lng, distance in cur:
+                i, j = rows[home_id], columns[poi]
+                if (h_lat, h_lng, p_lat, p_lng) == (home_lat[i], home_lng[i], poi_lat[j], poi_lng[j]):
+                    distances[i, j] = distance
+        stale = np.isnan(distances)
+        if stale.any():
+            stale_rows, stale_columns = np.flatnonzero(stale.any(axis=1)), np.flatnonzero(stale.any(axis=0))
+            block = np.ix_(stale_rows, stale_columns)
+            distances[block] = np.where(stale[block],
+                                        distance_matrix(home_lat[stale_rows], home_lng[stale_rows],
+                                                        pois.iloc[stale_columns]),
+                                        distances[block])
+            with closing(self.con.cursor()) as cur:
+                cur.executemany("""
+                insert or replace into distances (home_id, poi, home_lat, home_lng, poi_lat, poi_lng, distance)
+                values (?, ?, ?, ?, ?, ?, ?)
+                """, [(ids[i], keys[j], home_lat[i], home_lng[i], poi_lat[j], poi_lng[j], distances[i, j])
+                      for i, j in zip(*np.nonzero(stale))])
+                self._commit()
+        return distances
+
+
+class CrawlJournal:
+    """
+    The search pages done in a crawl, so the searches of a failed run are resumed instead of done again
+    """
+
+    def __init__(self, cache: HomeCache, crawl_id, full_sweep: bool):
+        self.cache = cache
+        self.crawl_id = crawl_id
+        self.full_sweep = full_sweep
+
+    def get_page(self, search, page) -> Optional[List[Dict]]:
+        """Get the homes of a page done in this crawl, None if it was not done"""
+        return self.cache.get_crawl_page(self.crawl_id, search, page)
+
+    def set_page(self, search, page, homes: List[Dict]):
+        self.cache.set_crawl_page(self.crawl_id, search, page, homes)
+
+    def finish(self):
+        self.cache.finish_crawl(self.crawl_id)
+
 
 def get_home_cache():
     db = HomeCache(config["HOME_CACHE"]["PATH"])
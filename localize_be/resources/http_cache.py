@@ -0,0 +1,89 @@
+"""
+On-disk cache of the Immoweb responses, to send conditional requests and skip the extraction of unchanged pages
+"""
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import closing
+from typing import Any, Dict, Optional
+
+from localize_be.config import config
+
+
+class HttpCache:
+    """
+    For each url, the validators (ETag, Last-Modified) and the hash of the last body, with the payload that was
+    extracted from it.  The least recently used entries are evicted to stay under max_bytes of payloads.
+    Can be shared by the fetching threads.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        with self._lock, closing(self.con.cursor()) as cur:
+            cur.execute("""
+            create table if not exists responses (
+                url text primary key, etag text, last_modified text, body_hash text, payload blob, size int,
+                used_at real
+            )
+            """)
+            cur.execute("create index if not exists responses_used_at on responses(used_at)")
+            self.con.commit()
+            self._size = cur.execute("select coalesce(sum(size), 0) from responses").fetchone()[0]
+
+    def close(self):
+        self.con.close()
+
+    def validators(self, url) -> Dict[str, str]:
+        """Get the headers of a conditional request for the url, empty if it is not in the cache"""
+        with self._lock, closing(self.con.cursor()) as cur:
+            row = cur.execute("select etag, last_modified from responses where url=?", (url,)).fetchone()
+        headers = {}
+        if row and row[0]:
+            headers["If-None-Match"] = row[0]
+        if row and row[1]:
+            headers["If-Modified-Since"] = row[1]
+        return headers
+
+    def get(self, url, body_hash=None) -> Optional[Any]:
+        """
+        Get the payload extracted from the cached response (None if there is none), and mark it as used.
+        If body_hash is given, the cached response must have the same body.
+        """
+        with self._lock, closing(self.con.cursor()) as cur:
+            row = cur.execute("select body_hash, payload from responses where url=?", (url,)).fetchone()
+            if not row or (body_hash and row[0] != body_hash):
+                return None
+            cur.execute("update responses set used_at=? where url=?", (time.time(), url))
+            self.con.commit()
+        return json.loads(zlib.decompress(row[1]))
+
+    def put(self, url, etag, last_modified, body_hash, payload: Any):
+        """Save the response of the url, and evict the least recently used ones if the cache is too big"""
+        data = zlib.compress(json.dumps(payload).encode())
+        with self._lock, closing(self.con.cursor()) as cur:
+            old = cur.execute("select size from responses where url=?", (url,)).fetchone()
+            cur.execute("""
+            insert or replace into responses (url, etag, last_modified, body_hash, payload, size, used_at)
+            values (?, ?, ?, ?, ?, ?, ?)
+            """, (url, etag, last_modified, body_hash, data, len(data), time.time()))
+            self._size += len(data) - (old[0] if old else 0)
+            if self._size > self.max_bytes:
+                self._evict(cur)
+            self.con.commit()
+
+    def _evict(self, cur):
+        evicted = []
+        for url, size in cur.execute("select url, size from responses order by used_at").fetchall():
+            if self._size <= self.max_bytes:
+                break
+            evicted.append((url,))
+            self._size -= size
+        cur.executemany("delete from responses where url=?", evicted)
+
+
+def get_http_cache():
+    return HttpCache(config["IMMOWEB"]["HTTP_CACHE_PATH"], config["IMMOWEB"]["HTTP_CACHE_MB"] * 1024 * 1024)
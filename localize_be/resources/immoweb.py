@@ -1,125 +1,373 @@
 """
 Wrapper for Immoweb scraping
 """
+import hashlib
+import json
 import re
-from dataclasses import dataclass
+import threading
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Union
+from urllib.parse import urlencode, urlparse
 
+import prefect
 import requests
-import random
-import time
-import json
+from requests.adapters import HTTPAdapter
 
-from localize_be.config import logger
-from bs4 import BeautifulSoup
+from localize_be.config import config, logger
+from localize_be.resources.concurrency import CircuitBreaker, RateLimiter, map_concurrently
+from localize_be.resources.extract import Extractor, FallbackExtractor
+from localize_be.resources.http_cache import HttpCache, get_http_cache
+from localize_be.resources.page_archive import PageArchive, get_page_archive
 from fake_useragent import UserAgent
 
 BASE = "https://www.immoweb.be/fr"
 MAX_SEARCH_PAGES = 5
+# responses worth retrying
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# the requests to a host are refused for BREAKER_COOLDOWN seconds after BREAKER_FAILURES failures in a row
+BREAKER_FAILURES = 5
+BREAKER_COOLDOWN = 300
+# a request asked to wait longer than that (Retry-After) fails instead, to be tried again by a later run
+MAX_RETRY_AFTER = 120
+# (connect, read) timeout of a request in seconds, a stalled connection fails (and is retried) instead of holding
+# its thread and its connection of the pool
+TIMEOUT = (10, 60)
 
 
 @dataclass
 class SearchConfig:
+    """A search given by its urls"""
     search_url: str
     home_url: str
+    # type of the homes found, default to the name of the search
+    property_type: Optional[str] = None
+    max_pages: int = MAX_SEARCH_PAGES
+
+
+# property type => search page, fixed search parameters, home url
+PROPERTY_TYPES = {
+    "Home": (f"{BASE}/recherche", {"propertyTypes": "HOUSE", "transactionTypes": "FOR_SALE"},
+             f"{BASE}/annonce/maison/a-vendre/{{}}/{{}}/{{}}"),
+    "Land": (f"{BASE}/recherche/terrain-a-batir/a-vendre", {},
+             f"{BASE}/annonce/terrain-a-batir/a-vendre/{{}}/{{}}/{{}}"),
+}
+
+
+@dataclass
+class SearchDefinition:
+    """A search given by its criteria, the urls are built from them"""
+    property_type: str
+    postal_codes: List[Union[int, str]] = field(default_factory=list)
+    min_price: Optional[int] = None
+    max_price: Optional[int] = None
+    min_surface: Optional[int] = None
+    max_surface: Optional[int] = None
+    min_land_surface: Optional[int] = None
+    max_land_surface: Optional[int] = None
+    min_bedrooms: Optional[int] = None
+    max_pages: int = MAX_SEARCH_PAGES
+
+    @property
+    def search_url(self) -> str:
+        page, params, _ = PROPERTY_TYPES[self.property_type]
+        criteria = {
+            "countries": "BE",
+            "postalCodes": ",".join(f"BE-{code}" for code in self.postal_codes) or None,
+            "minPrice": self.min_price,
+            "maxPrice": self.max_price,
+            "minSurface": self.min_surface,
+            "maxSurface": self.max_surface,
+            "minLandSurface": self.min_land_surface,
+            "maxLandSurface": self.max_land_surface,
+            "minBedroomCount": self.min_bedrooms,
+            "priceType": "PRICE",
+            # the incremental crawl relies on the order
+            "orderBy": "newest",
+        }
+        return f"{page}?" + urlencode(dict(params, **{k: v for k, v in criteria.items() if v is not None}),
+                                      safe=",")
+
+    @property
+    def home_url(self) -> str:
+        return PROPERTY_TYPES[self.property_type][2]
 
 
 SEARCHES = {
-    "Home": SearchConfig(
-        search_url="https://www.immoweb.be/fr/recherche?propertyTypes=HOUSE"
-                   "&minSurface=140&maxSurface=350&maxLandSurface=5000"
-                   "&postalCodes=BE-1315,BE-1360,BE-1367,BE-1370,BE-1457,BE-5030,BE-5031,BE-5080,BE-5310"
-                   "&transactionTypes=FOR_SALE&minPrice=175000&priceType=PRICE&minBedroomCount=3&countries=BE"
-                   "&maxPrice=470000&orderBy=newest",
-        home_url="https://www.immoweb.be/fr/annonce/maison/a-vendre/{}/{}/{}"
+    "Home": SearchDefinition(
+        property_type="Home", postal_codes=[1315, 1360, 1367, 1370, 1457, 5030, 5031, 5080, 5310],
+        min_price=175000, max_price=470000, min_surface=140, max_surface=350, max_land_surface=5000, min_bedrooms=3
     ),
-    "Land": SearchConfig(
-        search_url="https://www.immoweb.be/fr/recherche/terrain-a-batir/a-vendre?"
-                   "countries=BE&maxLandSurface=5000&maxPrice=180000&minLandSurface=800&minPrice=50000&"
-                   "postalCodes=BE-5081,BE-1360,BE-5031,BE-5310&priceType=PRICE&orderBy=newest",
-        home_url="https://www.immoweb.be/fr/annonce/terrain-a-batir/a-vendre/{}/{}/{}"
+    "Land": SearchDefinition(
+        property_type="Land", postal_codes=[5081, 1360, 5031, 5310],
+        min_price=50000, max_price=180000, min_land_surface=800, max_land_surface=5000
     )
 }
 
 
+def load_searches(path: Optional[str] = None) -> Dict[str, SearchDefinition]:
+    """
+    Load the searches from a JSON file holding name => criteria (the fields of SearchDefinition), or the
+    default ones if no path is given
+    """
+    if not path:
+        return SEARCHES
+    with open(path) as f:
+        return {name: SearchDefinition(**criteria) for name, criteria in json.load(f).items()}
+
+
 class ImmowebAPI:
-    def __init__(self, get_delay_range=(3, 10)):
-        self.get_delay_range = get_delay_range
+    def __init__(self, requests_per_minute=None, searches=None, extractor: Extractor = None, max_in_flight=None,
+                 archive: PageArchive = None, http_cache: HttpCache = None, retries=None, backoff=None,
+                 timeout=TIMEOUT):
+        """
+        :param requests_per_minute: politeness budget, shared by all the threads using this instance (0 for no
+            limit)
+        :param max_in_flight: number of threads fetching with this instance, the connection pool is sized to keep
+            one connection alive for each of them
+        :param searches: SearchDefinition or SearchConfig by name, default to SEARCHES
+        :param extractor: how to get the JSON payloads out of the pages, default to the fast path with a fallback
+            on the full parse
+        :param archive: where to keep the payloads of the fetched homes, not kept if not given
+        :param http_cache: cache of the responses, to send conditional requests and skip the extraction of the
+            unchanged pages (no cache if not given)
+        :param retries: number of retries of a request that failed with a connection error, a 429 or a 5xx
+        :param backoff: seconds to wait before the first retry, doubled at each retry (unless the response
+            has a Retry-After)
+        :param timeout: (connect, read) timeout of a request, in seconds
+        """
+        if requests_per_minute is None:
+            requests_per_minute = config["IMMOWEB"]["REQUESTS_PER_MINUTE"]
+        self.rate_limiter = RateLimiter(requests_per_minute)
+        self.searches = searches or SEARCHES
+        self.extractor = extractor or FallbackExtractor()
+        self.archive = archive
+        self.http_cache = http_cache
+        self.cache_stats = Counter()
+        self._lock = threading.Lock()
+        self.retries = config["IMMOWEB"]["RETRIES"] if retries is None else retries
+        self.backoff = config["IMMOWEB"]["BACKOFF_SECONDS"] if backoff is None else backoff
+        self.timeout = timeout
+        self.breakers = defaultdict(lambda: CircuitBreaker(BREAKER_FAILURES, BREAKER_COOLDOWN))
+        if max_in_flight is None:
+            max_in_flight = config["IMMOWEB"]["MAX_IN_FLIGHT"]
         self.session = requests.Session()
-        ua = UserAgent()
-        self.session.headers['User-Agent'] = ua.random
-
-    def search_homes(self):
-        for property_type, search in SEARCHES.items():
-            for page in range(1, MAX_SEARCH_PAGES + 1):
-                logger.debug(f"search {property_type}: retrieving page {page}")
-                url = search.search_url
-                if page > 1:
-                    url += '&page={}'.format(page)
-                search_page = self._download(url)
-                # the data is in a JSON
-                results = search_page.find('iw-search').attrs[':results']
-                results = json.loads(results)
-                for home in results:
-                    price = home["price"]["mainValue"] or home["price"]["maxRangeValue"]
-                    if not price:
-                        continue
-                    yield {
-                        "id": int(home["id"]),
-                        "city": home["property"]["location"]["locality"],
-                        "postal_code": str(home["property"]["location"]["postalCode"]),
-                        "price": price,
-                        "property_type": property_type,
-                    }
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, max_in_flight), pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers['User-Agent'] = _user_agent()
+
+    def search_homes(self, nothing_new: Callable[[str, List[Dict]], bool] = None, journal=None):
+        """
+        Yield the homes of the search results, with the name of the search that found them.
+        The searches run side by side: the next page of each search is fetched concurrently (within the rate
+        limit), and the callbacks are called from the calling thread.
+
+        :param nothing_new: called with the search name and the homes of each page, stop paging that search
+            when it returns True (all the pages are fetched if not given)
+        :param journal: CrawlJournal of the crawl, the pages it has are not fetched again, the others are added
+        """
+        searching = list(self.searches)
+        page = 1
+        while searching:
+            results = {name: journal.get_page(name, page) if journal else None for name in searching}
+            done = [name for name, homes in results.items() if homes is not None]
+            if done:
+                logger.debug(f"searches {done}: page {page} already done")
+            to_fetch = [name for name, homes in results.items() if homes is None]
+            for name, homes in map_concurrently(lambda n: self.search_page(n, page), to_fetch, len(to_fetch)):
+                if isinstance(homes, Exception):
+                    raise homes
+                results[name] = homes
+                if journal:
+                    journal.set_page(name, page, homes)
+            for name in list(searching):
+                homes = results[name]
+                yield from homes
+                if page >= self.searches[name].max_pages:
+                    searching.remove(name)
+                elif nothing_new and nothing_new(name, homes):
+                    logger.debug(f"search {name}: nothing new on page {page}, stopping")
+                    searching.remove(name)
+            page += 1
+
+    def search_page(self, name, page) -> List[Dict]:
+        logger.debug(f"search {name}: retrieving page {page}")
+        search = self.searches[name]
+        url = search.search_url
+        if page > 1:
+            url += '&page={}'.format(page)
+        # the data is in a JSON
+        results = self._fetch(url, self.extractor.search_results)
+        homes = []
+        for home in results:
+            price = home["price"]["mainValue"] or home["price"]["maxRangeValue"]
+            if not price:
+                continue
+            homes.append({
+                "id": int(home["id"]),
+                "city": home["property"]["location"]["locality"],
+                "postal_code": str(home["property"]["location"]["postalCode"]),
+                "price": price,
+                "property_type": search.property_type or name,
+                "search": name,
+            })
+        return homes
+
+    def home_url(self, property_type) -> str:
+        """The home url of the first search of that property type"""
+        for name, search in self.searches.items():
+            if (search.property_type or name) == property_type:
+                return search.home_url
+        raise KeyError(f"No search for property type {property_type}")
 
     def get_home(self, id_, property_type, locality, postal_code):
         # https://www.immoweb.be/fr/annonce/maison/a-louer/mont-st-guibert/1435/8736394?searchId=5ecb8fc950a33
         logger.debug(f'Getting home {id_}')
-        url = SEARCHES[property_type].home_url.format(
+        url = self.home_url(property_type).format(
             re.sub('[^a-z]', '-', locality.lower()),
             postal_code,
             id_)
-        soup = self._download(url)
-        data = soup.find('script', string=re.compile("^\\s*window.classified = "))
-        if not data:
-            raise Exception("Could not find classified in document")
-        script_content = data.contents[0]
-        assert isinstance(script_content, str)
-        script_content = re.sub('^\\s*window.classified = ', '', script_content)
-        script_content = re.sub(';\\s*$', '', script_content)
         # the data is in a JSON in "classified"
-        ad = json.loads(script_content)
-        prop_data = ad['property']
-        location = prop_data['location']
-        price = ad["price"]["mainValue"] or ad["price"]["maxRangeValue"]
-        return {
-            'Code #': ad['id'],
-            'Type': property_type,
-            'Postal code': prop_data['location']['postalCode'],
-            'Price': price,
-            'City': locality,
-            'Street': '{} {}'.format(location['street'], location['number'] or '') if location['street'] else '',
-            'SqMeter': prop_data['netHabitableSurface'],
-            'Land': (prop_data['land'] or {}).get('surface', 0),
-            'Lat': location['latitude'],
-            'Lng': location['longitude'],
-            'Bedrooms': prop_data['bedroomCount'],
-            'Attic': 'Yes' if prop_data['hasAttic'] else 'No',
-            'Basement': 'Yes' if prop_data['hasBasement'] else 'No',
-            'Garage': 'Yes' if prop_data['parkingCountIndoor'] else 'No',
-            'Pool': 'Yes' if prop_data['hasSwimmingPool'] else 'No',
-            'Office': 'Yes' if ((prop_data.get('specificities') or {}).get('office') or {}).get('surface') else 'No',
-            'Energy': (ad['transaction']['certificates'] or {}).get('epcScore'),
-            'Image.Url': ad['media']['pictures'][0]['mediumUrl'],
-            'Link.Url': url
-        }
+        ad = self._fetch(url, self.extractor.classified)
+        if self.archive:
+            try:
+                self.archive.save(id_, ad, property_type, locality, url)
+            except Exception as e:
+                logger.warning(f"Could not archive home {id_}: {e}")
+        return home_details(ad, property_type, locality, url)
+
+    def _fetch(self, url, extract: Callable[[bytes], Any]) -> Any:
+        """Download the page and extract its payload, or get the payload from the cache if the page is unchanged"""
+        if not self.http_cache:
+            return extract(self._download(url).content)
+        r = self._download(url, self.http_cache.validators(url))
+        if r.status_code == 304:
+            payload = self.http_cache.get(url)
+            if payload is not None:
+                self._count("not_modified")
+                return payload
+            # evicted in the meantime
+            r = self._download(url)
+        body_hash = hashlib.sha1(r.content).hexdigest()
+        payload = self.http_cache.get(url, body_hash)
+        if payload is not None:
+            self._count("unchanged")
+        else:
+            self._count("miss")
+            payload = extract(r.content)
+        self.http_cache.put(url, r.headers.get("ETag"), r.headers.get("Last-Modified"), body_hash, payload)
+        return payload
+
+    def _download(self, url, headers=None):
+        with self._lock:
+            breaker = self.breakers[urlparse(url).netloc]
+        for attempt in range(self.retries + 1):
+            breaker.check()
+            self.rate_limiter.wait()
+            delay = None
+            try:
+                r = self.session.get(url, headers=headers, timeout=self.timeout)
+                if r.status_code not in RETRY_STATUSES:
+                    breaker.success()
+                    r.raise_for_status()
+                    return r
+                error = requests.HTTPError(f"{r.status_code} Error for url: {url}", response=r)
+                delay = _retry_after(r)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            breaker.failure()
+            if attempt == self.retries or (delay or 0) > MAX_RETRY_AFTER:
+                raise error
+            delay = self.backoff * 2 ** attempt if delay is None else delay
+            logger.warning(f"{error}, retrying in {delay:.0f} s")
+            time.sleep(delay)
+
+    def _count(self, key):
+        with self._lock:
+            self.cache_stats[key] += 1
+
+    def connection_stats(self) -> Dict[str, int]:
+        """Number of connections opened and of requests sent on an already open connection"""
+        opened = requests_sent = 0
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                opened += pool.num_connections
+                requests_sent += pool.num_requests
+        return {"opened": opened, "reused": requests_sent - opened}
+
+    def close(self):
+        logger.debug(f"Closing Immoweb session, connections: {self.connection_stats()}, "
+                     f"cache: {dict(self.cache_stats)}")
+        self.session.close()
+        if self.archive:
+            self.archive.close()
+        if self.http_cache:
+            self.http_cache.close()
+
+
+def home_details(ad: Dict, property_type, locality, url) -> Dict:
+    """Get the home details from the window.classified payload of its page"""
+    prop_data = ad['property']
+    location = prop_data['location']
+    price = ad["price"]["mainValue"] or ad["price"]["maxRangeValue"]
+    return {
+        'Code #': ad['id'],
+        'Type': property_type,
+        'Postal code': prop_data['location']['postalCode'],
+        'Price': price,
+        'City': locality,
+        'Street': '{} {}'.format(location['street'], location['number'] or '') if location['street'] else '',
+        'SqMeter': prop_data['netHabitableSurface'],
+        'Land': (prop_data['land'] or {}).get('surface', 0),
+        'Lat': location['latitude'],
+        'Lng': location['longitude'],
+        'Bedrooms': prop_data['bedroomCount'],
+        'Attic': 'Yes' if prop_data['hasAttic'] else 'No',
+        'Basement': 'Yes' if prop_data['hasBasement'] else 'No',
+        'Garage': 'Yes' if prop_data['parkingCountIndoor'] else 'No',
+        'Pool': 'Yes' if prop_data['hasSwimmingPool'] else 'No',
+        'Office': 'Yes' if ((prop_data.get('specificities') or {}).get('office') or {}).get('surface') else 'No',
+        'Energy': (ad['transaction']['certificates'] or {}).get('epcScore'),
+        'Image.Url': ad['media']['pictures'][0]['mediumUrl'],
+        'Link.Url': url
+    }
+
+
+def _retry_after(r):
+    try:
+        return float(r.headers["Retry-After"])
+    except (KeyError, ValueError):
+        # missing, or a date
+        return None
+
+
+@lru_cache
+def _user_agent() -> str:
+    # UserAgent() loads its browser database, only do it once
+    return UserAgent().random
+
 
-    def _download(self, url):
-        time.sleep(random.randrange(*self.get_delay_range))
-        r = self.session.get(url)
-        r.raise_for_status()
-        soup = BeautifulSoup(r.content, "html.parser")
-        return soup
+_run_apis: Dict[str, ImmowebAPI] = {}
+_run_apis_lock = threading.Lock()
 
 
-def get_immoweb():
-    return ImmowebAPI()
+def get_immoweb() -> ImmowebAPI:
+    """
+    The ImmowebAPI of the current flow run, shared by its tasks so they use the same connections and the same
+    rate limit
+    """
+    run_id = prefect.context.get("flow_run_id")
+    with _run_apis_lock:
+        if run_id not in _run_apis:
+            # a new run, the sessions of the previous ones are no longer used
+            for api in _run_apis.values():
+                api.close()
+            _run_apis.clear()
+            _run_apis[run_id] = ImmowebAPI(searches=load_searches(config["IMMOWEB"]["SEARCHES_PATH"]),
+                                           archive=get_page_archive(), http_cache=get_http_cache())
+        return _run_apis[run_id]
@@ -0,0 +1,42 @@
+"""
+Offline geocoding of the localities, from the centroids in geocodes.csv
+"""
+import os.path
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+
+import pandas as pd
+
+from localize_be.config import config, logger
+from localize_be.resources.geocode_cache import normalize_address
+
+# status of the geocodes.csv rows that were geocoded
+FOUND = 200
+
+
+class LocalityIndex:
+    def __init__(self, centroids: Dict[str, Tuple[float, float]]):
+        """
+        :param centroids: normalized locality name => lat, lng
+        """
+        self.centroids = centroids
+
+    @classmethod
+    def from_csv(cls, path) -> "LocalityIndex":
+        """Load the localities from a CSV with Status;Exactitude;Lat;Lng;City"""
+        df = pd.read_csv(path, sep=";")
+        df = df[df.Status == FOUND]
+        return cls({normalize_address(city): (lat, lng) for city, lat, lng in zip(df.City, df.Lat, df.Lng)})
+
+    def get(self, locality: str) -> Optional[Tuple[float, float]]:
+        """Get the lat, lng of the centroid of the locality, None if it is unknown"""
+        return self.centroids.get(normalize_address(locality or ""))
+
+
+@lru_cache
+def get_locality_index() -> LocalityIndex:
+    path = config["MAPQUEST"]["LOCALITIES_PATH"]
+    if not os.path.exists(path):
+        logger.warning(f"No locality file {path}, the localities are geocoded online")
+        return LocalityIndex({})
+    return LocalityIndex.from_csv(path)
@@ -1,31 +1,133 @@
-from typing import Tuple
+from typing import List, Tuple, Union
 
 import requests
+from requests.adapters import HTTPAdapter
 
-from localize_be.config import config
+from localize_be.config import config, logger
+from localize_be.resources.concurrency import RateLimiter, map_concurrently
+from localize_be.resources.geocode_cache import GeocodeCache, get_geocode_cache, normalize_address
 
 COUNTRY = "Belgium"
+BASE_URL = "http://www.mapquestapi.com/geocoding/v1"
+# maximum number of locations in a batch request
+BATCH_SIZE = 100
+# (connect, read) timeout of a batch request in seconds
+TIMEOUT = (10, 120)
+
+Geocode = Tuple[float, float, str]
+
+
+class QuotaExceededError(Exception):
+    pass
 
 
 class Mapquest:
-    def __init__(self, api_key):
+    def __init__(self, api_key, cache: GeocodeCache = None, base_url=BASE_URL, requests_per_minute=0,
+                 max_in_flight=1, daily_quota=0, timeout=TIMEOUT):
+        """
+        :param cache: where to look for the addresses before calling the API, and to save the results.  The
+            locations sent each day are counted there.
+        :param requests_per_minute: rate limit of the batch requests (0 for no limit)
+        :param max_in_flight: number of batch requests sent concurrently
+        :param daily_quota: maximum number of locations sent each day (0 for no quota, needs a cache)
+        :param timeout: (connect, read) timeout of a batch request, in seconds
+        """
         self.api_key = api_key
+        self.cache = cache
+        self.base_url = base_url
+        self.rate_limiter = RateLimiter(requests_per_minute)
+        self.max_in_flight = max_in_flight
+        self.daily_quota = daily_quota
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=max(1, max_in_flight))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
 
     def geocode(self, address: str) -> Tuple[int, int]:
         """
         Return a tuple of lat, lng
         """
-        r = requests.get("http://www.mapquestapi.com/geocoding/v1/address", params={
-            "key": self.api_key,
-            "location": f"{address}, {COUNTRY}",
-            "maxResults": 1,
-            "outFormat": "json"
-        })
+        lat, lng, _ = self.geocode_with_quality(address)
+        return lat, lng
+
+    def geocode_with_quality(self, address: str) -> Geocode:
+        """
+        Return a tuple of lat, lng and the geocode quality (ADDRESS, STREET, CITY...)
+        """
+        result = self.geocode_many([address])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def geocode_many(self, addresses: List[str]) -> List[Union[Geocode, Exception]]:
+        """
+        Geocode the addresses with as few requests as possible: the ones in the cache are not sent, the others are
+        sent by batches of BATCH_SIZE.
+
+        :returns: for each address, (lat, lng, quality), or the exception if it could not be geocoded
+        """
+        # by normalized address, like the cache, so the spellings of an address are sent once
+        keys = [normalize_address(address) for address in addresses]
+        results, to_geocode = {}, {}
+        for key, address in zip(keys, addresses):
+            if key in results or key in to_geocode:
+                continue
+            cached = self.cache.get(address) if self.cache else None
+            if cached:
+                results[key] = cached
+            else:
+                to_geocode[key] = address
+        logger.debug(f"Geocoding {len(to_geocode)} addresses, {len(results)} found in cache")
+        to_geocode = list(to_geocode.values())
+        batches = [tuple(to_geocode[start:start + BATCH_SIZE]) for start in range(0, len(to_geocode), BATCH_SIZE)]
+        for batch, geocodes in map_concurrently(self._geocode_batch, batches, self.max_in_flight):
+            if isinstance(geocodes, Exception):
+                logger.warning(f"Could not geocode a batch of {len(batch)} addresses: {geocodes}")
+                geocodes = [geocodes] * len(batch)
+            results.update(zip(map(normalize_address, batch), geocodes))
+        return [results[key] for key in keys]
+
+    def _geocode_batch(self, addresses: List[str]) -> List[Union[Geocode, Exception]]:
+        if self.cache and not self.cache.reserve(len(addresses), self.daily_quota):
+            raise QuotaExceededError(f"Daily quota of {self.daily_quota} locations reached")
+        try:
+            self.rate_limiter.wait()
+            r = self.session.post(f"{self.base_url}/batch", params={"key": self.api_key}, json={
+                "locations": [f"{address}, {COUNTRY}" for address in addresses],
+                "options": {"maxResults": 1},
+            }, timeout=self.timeout)
+        except Exception:
+            # without a response the locations were not counted by Mapquest
+            if self.cache:
+                self.cache.release(len(addresses))
+            raise
         r.raise_for_status()
-        loc = r.json()["results"][0]["locations"][0]["latLng"]
-        return loc["lat"], loc["lng"]
+        # the results are in the order of the locations
+        batch_results = r.json()["results"]
+        if len(batch_results) != len(addresses):
+            raise ValueError(f"Got {len(batch_results)} results for {len(addresses)} addresses")
+        geocodes = []
+        for address, result in zip(addresses, batch_results):
+            if not result["locations"]:
+                geocodes.append(LookupError(f"Address not found: {address}"))
+                continue
+            location = result["locations"][0]
+            geocode = (location["latLng"]["lat"], location["latLng"]["lng"], location.get("geocodeQuality"))
+            if self.cache:
+                self.cache.put(address, *geocode)
+            geocodes.append(geocode)
+        return geocodes
+
+    def close(self):
+        self.session.close()
+        if self.cache:
+            self.cache.close()
 
 
 def get_mapquest():
-    svc = Mapquest(config["MAPQUEST"]["API_KEY"])
+    svc = Mapquest(config["MAPQUEST"]["API_KEY"], get_geocode_cache(),
+                   requests_per_minute=config["MAPQUEST"]["REQUESTS_PER_MINUTE"],
+                   max_in_flight=config["MAPQUEST"]["MAX_IN_FLIGHT"],
+                   daily_quota=config["MAPQUEST"]["DAILY_QUOTA"])
     return svc
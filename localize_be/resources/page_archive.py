@@ -0,0 +1,78 @@
+"""
+Archive of the raw Immoweb payloads, to extract the home details again without fetching the pages
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import closing
+from typing import Dict, Iterator, Tuple
+
+from localize_be.config import config
+
+
+class PageArchive:
+    """
+    Compressed payloads, stored once by content hash, and the fetches (listing id, time) that returned them.
+    Can be shared by the fetching threads.
+    """
+
+    def __init__(self, path):
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, closing(self.con.cursor()) as cur:
+            cur.execute("create table if not exists payloads (hash text primary key, data blob)")
+            cur.execute("""
+            create table if not exists fetches (
+                home_id int, fetched_at real, hash text, property_type text, locality text, url text,
+                primary key (home_id, fetched_at)
+            )
+            """)
+            self.con.commit()
+
+    def close(self):
+        self.con.close()
+
+    def save(self, home_id, payload: Dict, property_type, locality, url, fetched_at=None) -> str:
+        """Archive the payload (window.classified) of a listing, returns its hash"""
+        data = json.dumps(payload, sort_keys=True, separators=(",", ":")).encode()
+        hash_ = hashlib.sha1(data).hexdigest()
+        with self._lock, closing(self.con.cursor()) as cur:
+            cur.execute("insert or ignore into payloads (hash, data) values (?, ?)", (hash_, zlib.compress(data)))
+            cur.execute("""
+            insert or replace into fetches (home_id, fetched_at, hash, property_type, locality, url)
+            values (?, ?, ?, ?, ?, ?)
+            """, (home_id, fetched_at or time.time(), hash_, property_type, locality, url))
+            self.con.commit()
+        return hash_
+
+    def get(self, hash_) -> Dict:
+        with self._lock, closing(self.con.cursor()) as cur:
+            cur.execute("select data from payloads where hash=?", (hash_,))
+            return decompress(cur.fetchone()[0])
+
+    def iter_latest(self, chunk_size=500) -> Iterator[Tuple[int, str, str, str, bytes]]:
+        """
+        Stream the last fetch of each listing, as (home_id, property_type, locality, url, compressed payload).
+        The payloads are left compressed so they can be sent to other processes as is, see decompress.
+        """
+        with closing(self.con.cursor()) as cur:
+            cur.execute("""
+            select f.home_id, f.property_type, f.locality, f.url, p.data
+            from fetches f join payloads p on p.hash = f.hash
+            where f.fetched_at = (select max(fetched_at) from fetches where home_id = f.home_id)
+            """)
+            rows = cur.fetchmany(chunk_size)
+            while rows:
+                yield from rows
+                rows = cur.fetchmany(chunk_size)
+
+
+def decompress(data: bytes) -> Dict:
+    return json.loads(zlib.decompress(data))
+
+
+def get_page_archive():
+    return PageArchive(config["IMMOWEB"]["ARCHIVE_PATH"])
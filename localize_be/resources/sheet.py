@@ -1,9 +1,12 @@
 """
 Wrapper for Google API to update the spreadsheet
 """
+import json
 import os
 import os.path
-from typing import List
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional
 from typing import Tuple
 
 from googleapiclient.discovery import build
@@ -13,8 +16,14 @@ from google.oauth2.credentials import Credentials
 
 # If modifying these scopes, delete the file token.json.
 from localize_be.config import config, logger
+from localize_be.resources.sheet_state import SheetState, get_sheet_state, row_hash
 
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+# columns with formulas, they are only written when the home is added
+SKIP_HEADERS = {"Image", "Link", "Address"}
+# the requests sent in a call are kept under that size, well below the limit of the API
+MAX_BATCH_BYTES = 2 * 1024 * 1024
+ROWS_PER_RANGE = 500
 
 
 def build_service(conf_dir):
@@ -48,17 +57,67 @@ def build_service(conf_dir):
     return service.spreadsheets()
 
 
+@dataclass
+class SheetLayout:
+    headers: List[str]
+    # home id => index of its row (0 for the row after the headers)
+    rows: Dict[int, int]
+    # ids hidden by the filter
+    hidden: List[str] = field(default_factory=list)
+    # number of rows of the grid
+    row_count: int = 0
+    # index of the row after the last non-empty one of the first column, where new homes are written
+    next_row: int = 0
+
+
 class Sheet:
-    def __init__(self, spreadsheet_id, spreadsheet_gid, conf_dir="."):
+    def __init__(self, spreadsheet_id, spreadsheet_gid, conf_dir=".", tab="Houses", state: SheetState = None):
+        """
+        :param state: where the values written to the sheet are saved, to only send the cells that changed
+        """
         self.sheets = build_service(conf_dir)
         self.sheet_id = spreadsheet_id
         self.sheet_gid = spreadsheet_gid
+        self.tab = tab
+        self.state = state
+        self._layout = None
+        # changes waiting for the end of the batch: batchUpdate requests, value ranges, and cells for the state
+        self._batch_depth = 0
+        self._requests, self._values, self._rows = [], [], []
+
+    def close(self):
+        if self.state:
+            self.state.close()
 
-    def _get_headers(self):
-        result = self.sheets.values().get(spreadsheetId=self.sheet_id,
-                                          range="Houses!A1:ZZ1").execute()
-        values = result.get('values', [])
-        return values[0]
+    def _range(self, cells):
+        return f"'{self.tab}'!{cells}"
+
+    def layout(self) -> SheetLayout:
+        """
+        Get the headers, the rows of the homes and the filter of the tab, in a single call.  It is read once per
+        Sheet, so each sync sees the rows where they are (they may have been sorted or moved since the last one).
+        """
+        if self._layout:
+            return self._layout
+        sheet = self.sheets.get(
+            spreadsheetId=self.sheet_id,
+            ranges=[self._range("1:1"), self._range("A2:A")],
+            fields="sheets(basicFilter,properties.gridProperties,data.rowData.values.effectiveValue)"
+        ).execute()["sheets"][0]
+        headers, ids = [[[_value(cell) for cell in row.get("values", [])] for row in data.get("rowData", [])]
+                        for data in sheet["data"]]
+        headers = headers[0] if headers else []
+        # the empty cells at the end of the row are not headers
+        while headers and headers[-1] == "":
+            headers.pop()
+        self._layout = SheetLayout(
+            headers,
+            {_home_id(row[0]): i for i, row in enumerate(ids) if row and _home_id(row[0]) is not None},
+            _hidden_ids(sheet.get("basicFilter")),
+            sheet["properties"]["gridProperties"]["rowCount"],
+            max((i + 1 for i, row in enumerate(ids) if row and row[0] != ""), default=0)
+        )
+        return self._layout
 
     def get_homes(self):
         """
@@ -68,7 +127,7 @@ class Sheet:
         """
         request = self.sheets.values().get(
             spreadsheetId=self.sheet_id,
-            range="Houses!A2:E",
+            range=self._range("A2:E"),
         ).execute()
         result = []
         for i, row_values in enumerate(request['values']):
@@ -86,137 +145,248 @@ class Sheet:
 
     def upsert_homes(self, homes: List):
         """
-        Update values for existing homes, and append new homes
+        Update values for existing homes, and append new homes, in a single batch
         """
-        existing = self.get_homes()
-        existing_ids = {d[1]["id"] for d in existing}
-        new_homes = [h for h in homes if h["Code #"] not in existing_ids]
-        inserted = 0
-        logger.debug(f"Add {len(new_homes)} home(s) in spreadsheet")
-        if new_homes:
-            inserted = self.add_homes(new_homes)
-        updated_homes = [h for h in homes if h["Code #"] in existing_ids]
-        logger.debug(f"Update {len(updated_homes)} home(s) in spreadsheet")
-        updated = 0
-        if updated_homes:
-            updated = self.update_homes(existing, updated_homes)
+        with self.batch():
+            existing = [(index, {"id": id_}) for id_, index in self.layout().rows.items()]
+            existing_ids = {d[1]["id"] for d in existing}
+            new_homes = [h for h in homes if h["Code #"] not in existing_ids]
+            inserted = 0
+            logger.debug(f"Add {len(new_homes)} home(s) in spreadsheet")
+            if new_homes:
+                inserted = self.add_homes(new_homes)
+            updated_homes = [h for h in homes if h["Code #"] in existing_ids]
+            logger.debug(f"Update {len(updated_homes)} home(s) in spreadsheet")
+            updated = 0
+            if updated_homes:
+                updated = self.update_homes(existing, updated_homes)
         return (inserted, updated)
 
     def update_homes(self, existing: List[Tuple], homes: List):
         """
+        Write the cells that changed since the last sync.  Without a state all the cells of the homes are written.
+
         :param existing: an array of tuples (sheet index, home data)
-        :param homes: list of homes to add
+        :param homes: list of homes to update
+        :returns: the number of rows written
         """
-        headers = self._get_headers()
+        headers = self.layout().headers
         homes_by_id = {h["Code #"]: h for h in homes}
-        skip_headers = {"Image", "Link", "Address"}
-
-        def make_row(id_):
-            # Make row of data based on the id
-            # The values that need to be left unchanged are passed as null
-            # If no match in homes, return an empty list
-            home = homes_by_id.get(id_)
-            if not home:
-                return []
-            return [
-                home.get(h, None) if h not in skip_headers else None
-                for h in headers
-            ]
-
-        updated_rows = [
-            make_row(existing_home["id"])
-            for (_, existing_home) in existing
-        ]
-        result = self.sheets.values().update(
-            spreadsheetId=self.sheet_id,
-            range="Houses!A2",
-            valueInputOption="USER_ENTERED",
-            body={
-                "values": updated_rows
-            }
-        ).execute()
-        return result["updatedRows"]
+        written = self.state.get_rows(self.tab, list(homes_by_id)) if self.state else {}
+        updated = 0
+        with self.batch():
+            for index, existing_home in existing:
+                home = homes_by_id.get(existing_home["id"])
+                if not home:
+                    continue
+                cells = _cells(home, headers)
+                hash_, old_cells = written.get(existing_home["id"], (None, {}))
+                if row_hash(cells) == hash_:
+                    continue
+                self._rows.append((existing_home["id"], cells))
+                # the null values leave the cells unchanged
+                changed = [i for i, h in enumerate(headers)
+                           if cells.get(h) is not None and (h not in old_cells or old_cells[h] != cells[h])]
+                if not changed:
+                    continue
+                first, last = changed[0], changed[-1]
+                self._values.append({
+                    "range": self._range(f"{_column(first)}{index + 2}:{_column(last)}{index + 2}"),
+                    "values": [[cells[headers[i]] if i in changed else None for i in range(first, last + 1)]]
+                })
+                updated += 1
+        logger.debug(f"{updated} of {len(homes)} home(s) changed in spreadsheet")
+        return updated
 
     def add_homes(self, homes):
+        """
+        Write the homes in the rows after the last non-empty row of the first column (adding rows to the sheet if
+        needed), so the notes or totals below the homes are not overwritten
+        """
         for home in homes:
             # fix formulas
             home["Image"] = '=IMAGE(INDIRECT("RC[-1]", false), 4, 100, 120)'
             home["Link"] = '=HYPERLINK(INDIRECT("RC[-1]", false))'
             home["Address"] = f"{home['Street']}, {home['City']}" if home['Street'] else ''
-        headers = self._get_headers()
-        new_rows = [
-            [home.get(key, "") for key in headers]
-            for home in homes]
-        result = self.sheets.values().append(
-            spreadsheetId=self.sheet_id,
-            range="Houses!A1",
-            valueInputOption="USER_ENTERED",
-            body={
-                "values": new_rows
-            }
-        ).execute()
-        updated_range = result["updates"]["updatedRange"]
-        # extract start index from: Houses!A103:Z130
-        start_index = int(updated_range.split("!")[1].split(":")[0][1:]) - 1
-        updated_rows = result["updates"]["updatedRows"]
-        self.sheets.batchUpdate(
-            spreadsheetId=self.sheet_id,
-            body={
-                "requests": [
-                    {
-                        "updateDimensionProperties": {
-                            "range": {
-                                "sheetId": self.sheet_gid,
-                                "dimension": "ROWS",
-                                "startIndex": start_index,
-                                "endIndex": start_index + updated_rows
-                            },
-                            "properties": {
-                                "pixelSize": 100
-                            },
-                            "fields": "pixelSize"
-                        }
+        with self.batch():
+            layout = self.layout()
+            headers = layout.headers
+            new_rows = [
+                [home.get(key, "") for key in headers]
+                for home in homes]
+            # sheet index of the first new row, and number of the last one
+            start = layout.next_row
+            last_row = start + len(homes) + 1
+            if last_row > layout.row_count:
+                self._requests.append({
+                    "appendDimension": {
+                        "sheetId": self.sheet_gid,
+                        "dimension": "ROWS",
+                        "length": last_row - layout.row_count
                     }
-                ]
-            }).execute()
-        return updated_rows
+                })
+                layout.row_count = last_row
+            self._requests.append({
+                "updateDimensionProperties": {
+                    "range": {
+                        "sheetId": self.sheet_gid,
+                        "dimension": "ROWS",
+                        "startIndex": start + 1,
+                        "endIndex": last_row
+                    },
+                    "properties": {
+                        "pixelSize": 100
+                    },
+                    "fields": "pixelSize"
+                }
+            })
+            # in several ranges, so the values can be split between calls
+            for i in range(0, len(new_rows), ROWS_PER_RANGE):
+                rows = new_rows[i:i + ROWS_PER_RANGE]
+                self._values.append({
+                    "range": self._range(f"A{start + i + 2}:{_column(len(headers) - 1)}{start + i + len(rows) + 1}"),
+                    "values": rows
+                })
+            self._rows += [(home["Code #"], _cells(home, headers)) for home in homes]
+            layout.rows.update((home["Code #"], start + i) for i, home in enumerate(homes))
+            layout.next_row = start + len(homes)
+        return len(homes)
 
     def set_home_filter(self, exclude_ids: List[int]):
-        self.sheets.batchUpdate(
-            spreadsheetId=self.sheet_id,
-            body={
-                "requests": [
-                    {
-                        "setBasicFilter": {
-                            "filter": {
-                                "range": {
-                                    "sheetId": self.sheet_gid,
-                                    "startColumnIndex": 0,
-                                    "endColumnIndex": 1
-                                },
-                                "filterSpecs": [
-                                    {
-                                        "columnIndex": 0,
-                                        "filterCriteria": {
-                                            # "condition": {
-                                            #     "type": "ONE_OF_LIST",
-                                            #     "values": [
-                                            #         {
-                                            #             "userEnteredValue": "9477738"
-                                            #         }
-                                            #     ]
-                                            # }
-                                            "hiddenValues": list(map(str, exclude_ids))
-                                        }
-                                    }
-                                ]
+        """Hide the homes from the tab, unless the filter already hides exactly those"""
+        layout = self.layout()
+        if sorted(layout.hidden) == sorted(map(str, exclude_ids)):
+            logger.debug(f"Filter of {self.tab} unchanged")
+            return
+        with self.batch():
+            self._requests.append({
+                "setBasicFilter": {
+                    "filter": {
+                        "range": {
+                            "sheetId": self.sheet_gid,
+                            "startColumnIndex": 0,
+                            "endColumnIndex": 1
+                        },
+                        "filterSpecs": [
+                            {
+                                "columnIndex": 0,
+                                "filterCriteria": {
+                                    # "condition": {
+                                    #     "type": "ONE_OF_LIST",
+                                    #     "values": [
+                                    #         {
+                                    #             "userEnteredValue": "9477738"
+                                    #         }
+                                    #     ]
+                                    # }
+                                    "hiddenValues": list(map(str, exclude_ids))
+                                }
                             }
-                        }
+                        ]
                     }
-                ]
-            }
-        ).execute()
+                }
+            })
+            layout.hidden = list(map(str, exclude_ids))
+
+    @contextmanager
+    def batch(self):
+        """
+        Collect the changes made in the block, sent when the outermost block exits (or dropped if it raises): the
+        rows, formatting and filter in one batchUpdate, then the values in one values().batchUpdate.  Each is
+        split in several calls if it is over MAX_BATCH_BYTES.
+        """
+        self._batch_depth += 1
+        try:
+            yield
+        except BaseException:
+            if self._batch_depth == 1:
+                self._requests, self._values, self._rows = [], [], []
+            raise
+        finally:
+            self._batch_depth -= 1
+        if not self._batch_depth:
+            self._flush()
+
+    def _flush(self):
+        requests, values, rows = self._requests, self._values, self._rows
+        self._requests, self._values, self._rows = [], [], []
+        # the rows must be added before their values are written
+        for chunk in _chunks(requests):
+            self.sheets.batchUpdate(
+                spreadsheetId=self.sheet_id,
+                body={
+                    "requests": chunk
+                }
+            ).execute()
+        for chunk in _chunks(values):
+            self.sheets.values().batchUpdate(
+                spreadsheetId=self.sheet_id,
+                body={
+                    "valueInputOption": "USER_ENTERED",
+                    "data": chunk
+                }
+            ).execute()
+        logger.debug(f"Sent {len(requests)} request(s) and {len(values)} range(s) to {self.tab}")
+        if self.state:
+            self.state.put_rows(self.tab, rows)
+
+
+def _value(cell: Dict):
+    """Value of a cell of the grid data, "" if it is empty"""
+    value = cell.get("effectiveValue", {})
+    return value.get("numberValue", value.get("stringValue", value.get("boolValue", "")))
+
+
+def _home_id(value) -> Optional[int]:
+    """Id of the home in the first column, entered as a number or as text"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool) and value == int(value):
+        return int(value)
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value.strip())
+    return None
+
 
+def _hidden_ids(basic_filter: Dict = None) -> List[str]:
+    for spec in (basic_filter or {}).get("filterSpecs", []):
+        if spec.get("columnIndex", 0) == 0:
+            return spec.get("filterCriteria", {}).get("hiddenValues", [])
+    return []
 
-def get_sheet():
-    return Sheet(config["SHEET"]["SPREADSHEET_ID"], config["SHEET"]["SPREADSHEET_GID"])
+
+def _chunks(items: List[Dict], max_bytes=None) -> Iterator[List[Dict]]:
+    """Split the items in lists whose JSON is under max_bytes (MAX_BATCH_BYTES by default)"""
+    max_bytes = max_bytes or MAX_BATCH_BYTES
+    chunk, size = [], 0
+    for item in items:
+        item_size = len(json.dumps(item, default=str))
+        if chunk and size + item_size > max_bytes:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(item)
+        size += item_size
+    if chunk:
+        yield chunk
+
+
+def _cells(home: Dict, headers: List[str]) -> Dict:
+    """The values of the home that are synced, as header => value, as they are saved in the sheet state"""
+    return json.loads(json.dumps({h: home.get(h) for h in headers if h not in SKIP_HEADERS}, default=str))
+
+
+def _column(index: int) -> str:
+    """Letter(s) of the column at the index, from 0 => A"""
+    letters = ""
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord("A") + remainder) + letters
+    return letters
+
+
+def get_sheet(tab=None, gid=None):
+    """
+    Get the sheet for the tab, by default the one where the homes scored with the default profile go
+    """
+    if tab:
+        return Sheet(config["SHEET"]["SPREADSHEET_ID"], gid, tab=tab, state=get_sheet_state())
+    return Sheet(config["SHEET"]["SPREADSHEET_ID"], config["SHEET"]["SPREADSHEET_GID"], state=get_sheet_state())
@@ -0,0 +1,53 @@
+"""
+Local state of the spreadsheet, to only send what changed since the last sync
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+from contextlib import closing
+from typing import Dict, List, Tuple
+
+from localize_be.config import config
+
+
+def row_hash(cells: Dict) -> str:
+    return hashlib.sha1(json.dumps(cells, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class SheetState:
+    """
+    For each tab and home, the cells (header => value) last written to the sheet and their hash.
+    Can be shared by threads.
+    """
+
+    def __init__(self, path):
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, closing(self.con.cursor()) as cur:
+            cur.execute("""
+            create table if not exists rows (tab text, home_id int, hash text, cells text, primary key (tab, home_id))
+            """)
+            self.con.commit()
+
+    def close(self):
+        self.con.close()
+
+    def get_rows(self, tab, ids: List[int]) -> Dict[int, Tuple[str, Dict]]:
+        """Get the hash and the cells last written for the homes of the tab, as id => (hash, cells)"""
+        with self._lock, closing(self.con.cursor()) as cur:
+            cur.execute("""
+            select home_id, hash, cells from rows where tab=? and home_id in (select value from json_each(?))
+            """, (tab, json.dumps(ids)))
+            return {id_: (hash_, json.loads(cells)) for id_, hash_, cells in cur.fetchall()}
+
+    def put_rows(self, tab, rows: List[Tuple[int, Dict]]):
+        """Save the cells (id, header => value) written for the homes of the tab"""
+        with self._lock, closing(self.con.cursor()) as cur:
+            cur.executemany("insert or replace into rows (tab, home_id, hash, cells) values (?, ?, ?, ?)",
+                            [(tab, id_, row_hash(cells), json.dumps(cells, default=str)) for id_, cells in rows])
+            self.con.commit()
+
+
+def get_sheet_state():
+    return SheetState(config["SHEET"]["STATE_PATH"])
@@ -1,63 +1,218 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 from contextlib import closing
-from typing import List
+from typing import Dict, List
 
 import pandas as pd
 from prefect import task
 
-from localize_be.config import logger
+from localize_be.config import config, logger
+from localize_be.resources.concurrency import CircuitOpenError, map_concurrently
 from localize_be.resources.home_cache import get_home_cache
-from localize_be.resources.immoweb import get_immoweb
+from localize_be.core.scoring import score_fields
+from localize_be.resources.immoweb import get_immoweb, home_details
+from localize_be.resources.page_archive import decompress, get_page_archive
+
+
+# an unfinished crawl is resumed by the next run if it started less than that many hours ago
+CRAWL_RESUME_HOURS = 6
+# the listings that could not be fetched are tried again after that many seconds, doubled at each failure
+FETCH_RETRY_SECONDS = 3600
+MAX_FETCH_RETRY_SECONDS = 7 * 24 * 3600
+# the listing is gone, it is not tried again unless a search finds it again
+GONE_STATUSES = {404, 410}
 
 
 @task()
 def search_homes() -> pd.DataFrame:
-    """Retrieve from immoweb"""
-    # TODO pass configured search criteria somehow?
+    """
+    Retrieve from immoweb.  The searches stop at the first page without anything new, or that reaches the newest
+    listing of the last run (its checkpoint), unless a full sweep is due, which is flagged in the "full_sweep"
+    attribute of the result.
+    The pages are saved in the crawl journal, so if the run fails the next one does not fetch them again.  The
+    crawl is finished by finish_crawl, with the "crawl_id" attribute of the result.
+    """
     api = get_immoweb()
-    df = pd.DataFrame(data=list(api.search_homes()))
+    with closing(get_home_cache()) as cache:
+        journal = cache.start_crawl(_full_sweep_due(cache, list(api.searches)), CRAWL_RESUME_HOURS * 3600)
+        full_sweep = journal.full_sweep
+        logger.debug(f"Searching homes, crawl {journal.crawl_id}, full sweep: {full_sweep}")
+        nothing_new = None if full_sweep else _nothing_new(cache, list(api.searches))
+        df = pd.DataFrame(data=list(api.search_homes(nothing_new, journal)))
+        now = time.time()
+        with cache.transaction():
+            for name in api.searches:
+                homes = df[df.search == name] if len(df) else df
+                if len(homes):
+                    # the results are ordered by newest
+                    cache.set_search_checkpoint(name, int(homes.iloc[0].id), int(homes.iloc[0].price),
+                                                now if full_sweep else None)
+    if len(df):
+        # a home found by several searches is fetched and scored once
+        df = df.drop_duplicates("id").reset_index(drop=True)
+    # get_old_homes can only tell which homes are no longer listed after a full sweep
+    df.attrs["full_sweep"] = full_sweep
+    df.attrs["crawl_id"] = journal.crawl_id
     return df
 
 
+@task()
+def finish_crawl(search_result: pd.DataFrame):
+    """Mark the crawl of the search as finished, the next run starts a new one"""
+    with closing(get_home_cache()) as cache:
+        cache.finish_crawl(search_result.attrs["crawl_id"])
+
+
+def _full_sweep_due(cache, searches: List[str]) -> bool:
+    checkpoints = [cache.get_search_checkpoint(search) for search in searches]
+    oldest = min([(c["full_sweep_at"] or 0) if c else 0 for c in checkpoints], default=0)
+    return time.time() - oldest >= config["IMMOWEB"]["FULL_SWEEP_HOURS"] * 3600
+
+
+def _nothing_new(cache, searches: List[str]):
+    checkpoints = {search: cache.get_search_checkpoint(search) for search in searches}
+
+    def nothing_new(search: str, homes: List[Dict]) -> bool:
+        checkpoint = checkpoints[search]
+        newest = [home for home in homes if checkpoint and home["id"] == checkpoint["newest_id"]]
+        if newest and newest[0]["price"] == checkpoint["newest_price"]:
+            # the results are ordered by newest, the last run saw the ones on the next pages
+            return True
+        prices = cache.get_prices([home["id"] for home in homes])
+        return all(prices.get(home["id"]) == home["price"] for home in homes)
+    return nothing_new
+
+
 @task()
 def get_new_homes(search_result: pd.DataFrame):
-    """Get detailed information for the new houses (the ones that are not in cache yet)"""
+    """
+    Get detailed information for the new houses (the ones that are not in cache yet).  The houses in cache
+    whose price changed only get their price updated, which has them rescored and synced.
+    The houses that could not be fetched are tried again in a later run, with an exponential backoff, unless
+    their listing is gone (404 or 410).
+    """
+    api = get_immoweb()
     with closing(get_home_cache()) as cache:
+        listings = cache.classify_listings(search_result.to_dict("records"))
+        logger.debug(f"{len(listings['new'])} new homes, {len(listings['price_changed'])} with a price change, "
+                     f"{len(listings['unchanged'])} unchanged")
+        cache.update_prices([(home["id"], home["price"]) for home in listings["price_changed"]])
+        due, waiting = cache.get_fetch_failures()
+        waiting = set(waiting)
+        new_homes = [home for home in listings["new"] if home["id"] not in waiting]
+        # the failed ones are tried again even if they are not in the search results anymore
+        new_ids = {home["id"] for home in new_homes}
+        new_homes += [home for home in cache.classify_listings(due)["new"] if home["id"] not in new_ids]
+        logger.debug(f"{len(waiting)} homes waiting to be fetched again after a failure")
+
+        def fetch(home):
+            return api.get_home(home["id"], home["property_type"], home["city"], home["postal_code"])
+
         count = 0
-        for _, row in search_result.iterrows():
-            code = row.id
-            if not cache.has_home(code, row["price"]):
-                details = get_immoweb().get_home(code, row["property_type"], row["city"],
-                                                 row["postal_code"])
-                cache.add_home(row.to_dict(), details)
-                count += 1
-            else:
-                print("Already has home", code)
+        # the details are fetched in the background while the ones already received are saved
+        for home, details in map_concurrently(fetch, new_homes, config["IMMOWEB"]["MAX_IN_FLIGHT"]):
+            if isinstance(details, Exception):
+                _fetch_failed(cache, home, details)
+                continue
+            with cache.transaction():
+                cache.add_home(home, details)
+                cache.clear_fetch_failures([home["id"]])
+            count += 1
+        logger.debug(f"Immoweb connections: {api.connection_stats()}, cache: {dict(api.cache_stats)}")
         return count
 
 
 @task()
 def refetch_cached_homes():
+    api = get_immoweb()
     with closing(get_home_cache()) as cache:
+        homes = [dict(zip(row.keys(), row)) for row in cache.get_homes_missing_details()]
+
+        def fetch(home):
+            return api.get_home(home["id"], home["property_type"] or "Home", home["city"], home["postal_code"])
+
         count = 0
-        for row in cache.get_homes_missing_details():
-            try:
-                details = get_immoweb().get_home(row["id"],
-                                                 row["property_type"] or "Home",
-                                                 row["city"],
-                                                 row["postal_code"])
-                row_dict = dict(zip(row.keys(), row))
-                row_dict["price"] = details["Price"]
-                cache.add_home(row_dict, details)
-                count += 1
-            except Exception as e:
-                logger.warning(f"Could not fetch home {row['id']}: {e}")
+        for home, details in map_concurrently(fetch, homes, config["IMMOWEB"]["MAX_IN_FLIGHT"]):
+            if isinstance(details, Exception):
+                logger.warning(f"Could not fetch home {home['id']}: {details}")
+                continue
+            home["price"] = details["Price"]
+            cache.add_home(home, details)
+            count += 1
+        logger.debug(f"Immoweb connections: {api.connection_stats()}, cache: {dict(api.cache_stats)}")
     return count
 
 
+def _fetch_failed(cache, home, error):
+    logger.warning(f"Could not fetch home {home['id']}: {error}")
+    response = getattr(error, "response", None)
+    if response is not None and response.status_code in GONE_STATUSES:
+        cache.clear_fetch_failures([home["id"]])
+    # when the circuit is open the home was not even tried
+    elif not isinstance(error, CircuitOpenError):
+        cache.add_fetch_failure(home, error, FETCH_RETRY_SECONDS, MAX_FETCH_RETRY_SECONDS)
+
+
+# fields of the details given by the extraction but maintained by other tasks, kept when the details are extracted
+# again (the fields that the extraction does not give, such as the scores or the location precision, are kept too)
+KEPT_FIELDS = ("Price", "Lat", "Lng")
+
+
+@task()
+def reextract_homes(chunk_size=500):
+    """
+    Extract the details of the cached homes again from the archived pages (after a change in home_details),
+    in a pool of processes.  The homes whose details changed are set to be rescored and synced.  The pages that
+    cannot be extracted (e.g. in an older format) are skipped.
+    """
+    workers = os.cpu_count() or 1
+    with closing(get_page_archive()) as archive, closing(get_home_cache()) as cache, \
+            ProcessPoolExecutor(workers) as pool:
+        extracted, failed = {}, 0
+        fetches = archive.iter_latest(chunk_size)
+        # a chunk per process at a time, so the archive is not loaded in memory at once
+        while True:
+            batch = list(islice(fetches, chunk_size * workers))
+            if not batch:
+                break
+            for id_, details in pool.map(_extract, batch, chunksize=chunk_size):
+                if isinstance(details, Exception):
+                    logger.warning(f"Could not extract home {id_}: {details!r}")
+                    failed += 1
+                    continue
+                extracted[id_] = details
+        logger.debug(f"Extracted {len(extracted)} homes from the archive, {failed} failed")
+        updated = []
+        for id_, details in cache.iter_homes_with_details(chunk_size):
+            if id_ not in extracted:
+                continue
+            kept = {k: v for k, v in details.items() if k in KEPT_FIELDS or k not in extracted[id_]}
+            new_details = {**extracted[id_], **kept, **score_fields(details)}
+            if new_details != details:
+                updated.append((id_, new_details))
+        cache.update_homes(updated)
+    logger.debug(f"Details changed for {len(updated)} homes")
+    return len(updated)
+
+
+def _extract(fetch):
+    """(home id, details), or (home id, exception) if the page cannot be extracted"""
+    home_id, property_type, locality, url, data = fetch
+    try:
+        return home_id, home_details(decompress(data), property_type, locality, url)
+    except Exception as e:
+        return home_id, e
+
+
 @task()
 def get_old_homes(search_result: pd.DataFrame) -> List[int]:
     """Get homes that are marked as synced in the cache but are no longer in the search results
     (thus those are the ones that need to be removed or hidden from the results)"""
+    if not search_result.attrs.get("full_sweep", True):
+        logger.debug("Not a full sweep, the homes missing from the search results may still be listed")
+        return []
     with closing(get_home_cache()) as cache:
         search_ids = set(search_result.id)
         return [x for x in cache.get_synced_ids() if x not in search_ids]
@@ -15,14 +15,14 @@ from localize_be.resources.home_cache import get_home_cache
 def add_to_cache(homes: pd.DataFrame):
     prefect.context.logger.debug("add_to_cache: starting task execution")
     with closing(get_home_cache()) as cache:
-        for _, h in homes.iterrows():
-            cache.add_home(h.to_dict(), details={}, synced=True)
+        cache.add_homes([(h.to_dict(), {}) for _, h in homes.iterrows()], synced=True)
 
 
 @task()
 def get_homes():
     prefect.context.logger.debug("get_homes: starting task execution")
-    homes = get_sheet().get_homes()
+    with closing(get_sheet()) as sheet:
+        homes = sheet.get_homes()
     df = pd.DataFrame(data=[v[1] for v in homes])
     prefect.context.logger.debug("get_homes: finished task execution")
     return df
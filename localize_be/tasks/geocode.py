@@ -2,16 +2,76 @@ from contextlib import closing
 
 from prefect import task
 
+from localize_be.config import logger
 from localize_be.resources.home_cache import get_home_cache
-from localize_be.resources.mapquest import get_mapquest
+from localize_be.resources.localities import get_locality_index
+from localize_be.resources.mapquest import QuotaExceededError, get_mapquest
+
+# precision of the location of a home, saved in its "Geocode" field
+LISTING = "listing"
+ADDRESS = "address"
+STREET = "street"
+LOCALITY = "locality"
+
+# Mapquest geocode quality => precision
+QUALITY_PRECISION = {"POINT": ADDRESS, "ADDRESS": ADDRESS, "INTERSECTION": ADDRESS, "STREET": STREET}
+
+# the homes that could not be geocoded are tried again after that many seconds, doubled at each failure
+GEOCODE_RETRY_SECONDS = 6 * 3600
+MAX_GEOCODE_RETRY_SECONDS = 30 * 24 * 3600
 
 
 @task()
 def geocode_homes():
-    mapquest = get_mapquest()
+    """
+    Locate the homes, from the cheapest source to the most expensive one: the location given by the listing,
+    the centroid of the locality for the homes without a street, and Mapquest for the others.
+    The homes whose address Mapquest could not find are tried again in a later run, with an exponential backoff.
+    Past the daily quota, or when a batch fails, they are simply left for the next run.
+    """
+    localities = get_locality_index()
     with closing(get_home_cache()) as cache:
-        homes = cache.get_homes_to_geocode()
-        for id_, home in homes:
-            home["Lat"], home["Lng"] = mapquest.geocode(f"{home['Street']}, {home['Postal code']} {home['City']}")
-            cache.update_home(id_, home)
-            cache.set_geocoded(id_)
+        geocoded, to_geocode, failures = [], [], []
+        waiting = set(cache.get_geocode_waiting())
+        for id_, home in cache.get_homes_to_geocode():
+            if id_ in waiting:
+                continue
+            if home.get("Lat") is not None and home.get("Lng") is not None:
+                home["Geocode"] = LISTING
+                geocoded.append((id_, home))
+            elif not home.get("Street") and localities.get(home.get("City")):
+                home["Lat"], home["Lng"] = localities.get(home["City"])
+                home["Geocode"] = LOCALITY
+                geocoded.append((id_, home))
+            else:
+                to_geocode.append((id_, home))
+        logger.debug(f"{len(geocoded)} homes located offline, {len(to_geocode)} to geocode, "
+                     f"{len(waiting)} waiting after a failure")
+        if to_geocode:
+            with closing(get_mapquest()) as mapquest:
+                results = mapquest.geocode_many([_address(home) for _, home in to_geocode])
+            for (id_, home), result in zip(to_geocode, results):
+                if isinstance(result, LookupError):
+                    # the address was not found, it is not tried again before the backoff
+                    logger.warning(f"Could not geocode home {id_}: {result}")
+                    failures.append((id_, result))
+                    continue
+                if isinstance(result, Exception):
+                    # quota reached or the batch failed (Mapquest down...), left for the next run
+                    log = logger.debug if isinstance(result, QuotaExceededError) else logger.warning
+                    log(f"Home {id_} not geocoded: {result}")
+                    continue
+                home["Lat"], home["Lng"], quality = result
+                home["Geocode"] = QUALITY_PRECISION.get(quality, LOCALITY)
+                geocoded.append((id_, home))
+        with cache.transaction():
+            cache.update_homes(geocoded)
+            cache.set_geocoded_many([id_ for id_, _ in geocoded])
+            cache.clear_geocode_failures([id_ for id_, _ in geocoded])
+            cache.add_geocode_failures(failures, GEOCODE_RETRY_SECONDS, MAX_GEOCODE_RETRY_SECONDS)
+        return len(geocoded)
+
+
+def _address(home):
+    locality = f"{home['Postal code']} {home['City']}"
+    return f"{home['Street']}, {locality}" if home.get("Street") else locality
@@ -1,27 +1,44 @@
 """
 Collect pois from the pois.csv file and geocode them.
 """
+from contextlib import closing
+from typing import Dict
+
 import numpy as np
 import pandas as pd
 from prefect import task
 
 from localize_be.config import config
+from localize_be.core.profile import get_scoring_profiles
 from localize_be.resources.mapquest import get_mapquest
 
 
 @task()
 def get_pois(path: str = None) -> pd.DataFrame:
-    path = path or config["POIS"]["PATH"]
-    mapquest = get_mapquest()
+    return _load_pois(path or config["POIS"]["PATH"])
+
+
+@task()
+def get_profile_pois() -> Dict[str, pd.DataFrame]:
+    """Collect the POIs of each of the named scoring profiles"""
+    return {name: _load_pois(profile.pois_path or config["POIS"]["PATH"])
+            for name, profile in get_scoring_profiles().items()}
+
+
+def _load_pois(path: str) -> pd.DataFrame:
     df = pd.read_csv(path, sep=";")
     if "Lat" not in df.columns:
         df["Lat"], df["Lng"] = np.nan, np.nan
+    if not df.Lat.isna().any():
+        return df
 
-    def geocode(row):
-        if np.isnan(row.Lat):
-            return mapquest.geocode(row.Address)
-        return row.Lat, row.Lng
-
-    df["Lat"], df["Lng"] = zip(*df.apply(geocode, axis=1))
+    missing = df.Lat.isna()
+    with closing(get_mapquest()) as mapquest:
+        results = mapquest.geocode_many(list(df.Address[missing]))
+    errors = [r for r in results if isinstance(r, Exception)]
+    if errors:
+        raise errors[0]
+    df.loc[missing, "Lat"] = [lat for lat, _, _ in results]
+    df.loc[missing, "Lng"] = [lng for _, lng, _ in results]
     df.to_csv(path, sep=";", index=False)
     return df
@@ -1,21 +1,105 @@
 from contextlib import closing
+from itertools import islice
+from typing import Dict
 
 import pandas as pd
 from prefect import task
 
 from localize_be.config import logger
-from localize_be.core.scoring import calculate_score
+from localize_be.core.profile import ScoringProfile, get_scoring_profile, get_scoring_profiles
+from localize_be.core.scoring import (calculate_score, calculate_scores, pois_version, score_fields,
+                                      score_fingerprint, without_scores)
 from localize_be.resources.home_cache import get_home_cache
 
 
+# homes are streamed from the cache and scored by chunks of that size
+CHUNK_SIZE = 500
+
+
 @task()
-def score_all(pois: pd.DataFrame, rescore: bool = False):
+def score_all(pois: pd.DataFrame, rescore: bool = False, profile_pois: Dict[str, pd.DataFrame] = None):
+    """
+    Score the homes to sync (or all the geocoded homes, if rescore is set), with the default profile and with
+    each of the named profiles that have POIs in profile_pois.
+    Homes for which the score inputs did not change since the last scoring are skipped, and those whose score
+    ends up unchanged are left as synced.
+    """
+    profiles = get_scoring_profiles()
     with closing(get_home_cache()) as home_cache:
-        homes = home_cache.get_homes_to_sync() if not rescore else home_cache.get_homes_geocoded()
-        logger.debug(f"Scoring {len(homes)} homes")
-        for id_, details in homes:
-            try:
-                calculate_score(details, pois)
-                home_cache.update_home(id_, details)
-            except Exception as e:
-                logger.warning(f"Error updating score for home {id_}: {e}")
+        homes = home_cache.iter_homes_to_sync(CHUNK_SIZE) if not rescore else home_cache.iter_homes_geocoded(CHUNK_SIZE)
+        for chunk in _chunks(homes, CHUNK_SIZE):
+            chunk = _with_location(chunk)
+            # the named profiles score a copy of the details without the scores of the default profile
+            inputs = [(id_, without_scores(details)) for id_, details in chunk] if profile_pois else []
+            ids = [id_ for id_, _ in chunk]
+            fingerprints = home_cache.get_score_fingerprints(ids)
+            known = {id_: (score_fields(details), fingerprints.get(id_)) for id_, details in chunk}
+            scored = _score(home_cache, chunk, pois, get_scoring_profile(), known)
+            with home_cache.transaction():
+                home_cache.update_homes([(id_, details) for id_, details, _, changed in scored if changed],
+                                        {id_: fingerprint for id_, _, fingerprint, _ in scored})
+                home_cache.set_score_fingerprints({id_: fingerprint for id_, _, fingerprint, changed in scored
+                                                   if not changed})
+            for name, poi_set in (profile_pois or {}).items():
+                known = home_cache.get_profile_scores(name, ids)
+                scored = _score(home_cache, [(id_, dict(details)) for id_, details in inputs], poi_set,
+                                profiles[name], known)
+                with home_cache.transaction():
+                    for id_, details, fingerprint, changed in scored:
+                        if changed:
+                            home_cache.set_profile_scores(id_, name, score_fields(details), fingerprint)
+                        else:
+                            home_cache.set_profile_score_fingerprint(id_, name, fingerprint)
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def _score(home_cache, homes, pois: pd.DataFrame, profile: ScoringProfile, known):
+    """
+    Score the homes whose score inputs changed
+
+    :param known: id => (scores, score fingerprint) of the last scoring
+    :returns: list of (id, details, score fingerprint, score changed)
+    """
+    pois_ver = pois_version(pois)
+    fingerprints = {id_: score_fingerprint(details, pois_ver, profile) for id_, details in homes}
+    homes = [(id_, details) for id_, details in homes if fingerprints[id_] != known.get(id_, (None, None))[1]]
+    logger.debug(f"Scoring {len(homes)} homes with profile {profile.name}")
+    try:
+        # when scoring the nearest POIs the spatial index is used instead of the distance matrix
+        distances = home_cache.get_distances(homes, pois) if not profile.nearest else None
+        calculate_scores([details for _, details in homes], pois, profile, distances)
+    except Exception as e:
+        # one bad home fails the whole batch, score them one at a time to find it
+        logger.warning(f"Error in batch scoring, falling back to scoring homes one by one: {e}")
+        homes = _score_one_by_one(homes, pois, profile)
+    scored = [(id_, details, fingerprints[id_], score_fields(details) != known.get(id_, ({}, None))[0])
+              for id_, details in homes]
+    logger.debug(f"Score changed for {sum(s[3] for s in scored)} homes with profile {profile.name}")
+    return scored
+
+
+def _with_location(homes):
+    located = []
+    for id_, details in homes:
+        if details.get("Lat") is None or details.get("Lng") is None:
+            logger.warning(f"Error updating score for home {id_}: no location")
+        else:
+            located.append((id_, details))
+    return located
+
+
+def _score_one_by_one(homes, pois, profile):
+    scored = []
+    for id_, details in homes:
+        try:
+            scored.append((id_, calculate_score(details, pois, profile)))
+        except Exception as e:
+            logger.warning(f"Error updating score for home {id_}: {e}")
+    return scored
@@ -4,27 +4,53 @@ from typing import List
 from prefect import task
 
 from localize_be.config import logger
+from localize_be.core.profile import get_scoring_profiles
 from localize_be.resources.home_cache import get_home_cache
 from localize_be.resources.sheet import get_sheet
 
 
 @task()
-def filter_old(exclude_homes: List[int]):
-    """Apply filter on spreadsheet to show only houses that are in current search results"""
-    if exclude_homes:
-        get_sheet().set_home_filter(exclude_homes)
+def sync_new(exclude_homes: List[int] = None):
+    """
+    Sync newly added and updated houses and mark as synced in home cache.  The homes of exclude_homes (no longer
+    in the search results) are hidden by the filter, in the same batch.
+    """
+    with closing(get_home_cache()) as cache:
+        to_sync = cache.get_homes_to_sync()
+        logger.debug(f"Syncing {len(to_sync)} homes" if to_sync else "No home to sync")
+        if to_sync or exclude_homes:
+            with closing(get_sheet()) as sheet:
+                _update_sheet(sheet, [d[1] for d in to_sync], exclude_homes)
+            cache.set_synced_many([id_ for id_, _ in to_sync])
+        return len(to_sync)
 
 
 @task()
-def sync_new():
-    """Sync newly added and updated houses and mark as synced in home cache"""
+def sync_profiles(exclude_homes: List[int] = None):
+    """Sync the homes with new scores to the sheet tab of each named scoring profile, hiding exclude_homes"""
+    count = 0
     with closing(get_home_cache()) as cache:
-        to_sync = cache.get_homes_to_sync()
-        if to_sync:
-            logger.debug(f"Syncing {len(to_sync)} homes")
-            get_sheet().upsert_homes([d[1] for d in to_sync])
-            for id_, _ in to_sync:
-                cache.set_synced(id_)
-        else:
-            logger.debug("No home to sync")
-        return len(to_sync)
+        for profile in _synced_profiles():
+            to_sync = cache.get_profile_homes_to_sync(profile.name)
+            if to_sync or exclude_homes:
+                logger.debug(f"Syncing {len(to_sync)} homes for profile {profile.name}")
+                with closing(get_sheet(profile.sheet_tab, profile.sheet_gid)) as sheet:
+                    _update_sheet(sheet, [d[1] for d in to_sync], exclude_homes)
+                with cache.transaction():
+                    for id_, _ in to_sync:
+                        cache.set_profile_synced(id_, profile.name)
+                count += len(to_sync)
+    return count
+
+
+def _update_sheet(sheet, homes: List, exclude_homes: List[int] = None):
+    """Write the homes and set the filter of the tab in a single batch, after a single read of its layout"""
+    with sheet.batch():
+        if homes:
+            sheet.upsert_homes(homes)
+        if exclude_homes:
+            sheet.set_home_filter(exclude_homes)
+
+
+def _synced_profiles():
+    return [p for p in get_scoring_profiles().values() if p.sheet_tab]
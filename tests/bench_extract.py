@@ -0,0 +1,37 @@
+"""
+Compare the fast path and the full parse on the sample pages
+
+Run from the tests directory: PYTHONPATH=.. python bench_extract.py [repeat]
+"""
+import os.path
+import sys
+import timeit
+
+from conftest import SAMPLES
+from localize_be.resources.extract import FastExtractor, SoupExtractor
+
+PAGES = {
+    "iw_ad": "classified",
+    "iw_ad_2": "classified",
+    "iw_ad_3": "classified",
+    "iw_search": "search_results",
+}
+
+
+def main(repeat=20):
+    extractors = {"fast": FastExtractor(), "soup": SoupExtractor()}
+    print(f"{'page':<12}{'size (kB)':>10}" + "".join(f"{name + ' (ms)':>12}" for name in extractors)
+          + f"{'speedup':>10}")
+    for page, method in PAGES.items():
+        with open(os.path.join(SAMPLES, f"{page}.html"), "rb") as f:
+            content = f.read()
+        times = {
+            name: min(timeit.repeat(lambda: getattr(extractor, method)(content), number=1, repeat=repeat)) * 1000
+            for name, extractor in extractors.items()
+        }
+        print(f"{page:<12}{len(content) / 1024:>10.0f}" + "".join(f"{t:>12.2f}" for t in times.values())
+              + f"{times['soup'] / times['fast']:>9.0f}x")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
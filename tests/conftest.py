@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os.path
+import socket
+import threading
+from contextlib import ExitStack
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+import pytest
+
+from localize_be.resources.home_cache import HomeCache
+from localize_be.resources.immoweb import ImmowebAPI, SearchConfig
+
+SAMPLES = os.path.join(os.path.dirname(__file__), "samples")
+
+
+class SampleHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in for Immoweb: serves samples/<name>.html for /<name>/...
+    """
+    # keep the connections alive, like the real server
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.server.fail_next or any(p in self.path for p in self.server.fail_paths):
+            self.server.fail_next = max(0, self.server.fail_next - 1)
+            if self.server.retry_after:
+                self.send_response(503)
+                self.send_header("Retry-After", self.server.retry_after)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            else:
+                self.send_error(503)
+            return
+        name = self.path.strip("/").split("/")[0].split("?")[0]
+        path = os.path.join(SAMPLES, f"{name}.html")
+        if not os.path.exists(path):
+            self.send_error(404)
+            return
+        with open(path, "rb") as f:
+            content = f.read()
+        etag = f'"{hashlib.sha1(content).hexdigest()}"'
+        if self.server.etags and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        if self.server.etags:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def sample_server():
+    """Local HTTP server serving the sample pages, yields its base url"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SampleHandler)
+    server.requests = []
+    server.etags = True
+    # answer 503 to the next fail_next requests, and to the paths containing one of fail_paths
+    server.fail_next = 0
+    server.fail_paths = []
+    # sent with the 503 answers
+    server.retry_after = None
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class MapquestHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in for the Mapquest batch geocoding: the coordinates are derived from the address, the quality is
+    ADDRESS with a street ("street, locality, country") and CITY without, the addresses containing "unknown" are
+    not found, and a batch with an address containing "error" fails
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append(body["locations"])
+        if any("error" in location for location in body["locations"]):
+            self.send_error(500)
+            return
+        results = []
+        for location in body["locations"]:
+            digest = int(hashlib.sha1(location.encode()).hexdigest(), 16)
+            found = [] if "unknown" in location else [{
+                "latLng": {"lat": 50 + digest % 1000 / 1000, "lng": 4 + digest // 1000 % 1000 / 1000},
+                "geocodeQuality": "ADDRESS" if location.count(",") > 1 else "CITY"
+            }]
+            results.append({"providedLocation": {"location": location}, "locations": found})
+        content = json.dumps({"results": results}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def mapquest_server():
+    """Local stand-in for the Mapquest API, yields the server (base url: server.url)"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MapquestHandler)
+    server.requests = []
+    server.url = f"http://127.0.0.1:{server.server_port}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def silent_server():
+    """Base url of a server that accepts the connections but never answers"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        sock.listen()
+        yield f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+
+@pytest.fixture
+def sample_search(sample_server):
+    """Factory of searches on the sample server: sample_search(query="a=1", **SearchConfig arguments)"""
+    base = f"http://127.0.0.1:{sample_server.server_port}"
+
+    def make(query="a=1", **kwargs):
+        # the sample server picks the page from the first part of the path
+        return SearchConfig(search_url=f"{base}/iw_search?{query}", home_url=base + "/{1}/{0}/{2}", **kwargs)
+    return make
+
+
+@pytest.fixture
+def immoweb_api(sample_search):
+    """Factory of ImmowebAPI on the sample server, without rate limit: immoweb_api(**ImmowebAPI arguments)"""
+    def make(**kwargs):
+        kwargs.setdefault("searches", {"Home": sample_search()})
+        return ImmowebAPI(requests_per_minute=0, **kwargs)
+    return make
+
+
+# the tasks getting the home cache from get_home_cache
+TASK_MODULES = ["collect_homes", "fill_cache", "geocode", "score_homes", "sync"]
+
+
+@pytest.fixture
+def memory_cache():
+    """HomeCache in memory, returned by get_home_cache in the tasks (and not closed by them)"""
+    cache = HomeCache(":memory:")
+    cache.close = lambda: None
+    with ExitStack() as stack:
+        for module in TASK_MODULES:
+            stack.enter_context(patch(f"localize_be.tasks.{module}.get_home_cache", return_value=cache))
+        yield cache
@@ -1,9 +1,13 @@
+import os.path
 import tempfile
 from unittest.mock import MagicMock, patch
 
 import pandas as pd
+import pytest
+from conftest import SAMPLES
+from requests import HTTPError
 
-from localize_be.tasks.collect_homes import search_homes, get_new_homes, get_old_homes
+from localize_be.tasks.collect_homes import finish_crawl, search_homes, get_new_homes, get_old_homes, reextract_homes
 
 # def test_read_existing():
 #     context = build_op_context(op_config={"path": "samples/homes.csv"})
@@ -11,12 +15,15 @@ from localize_be.tasks.collect_homes import search_homes, get_new_homes, get_old
 #     assert df is not None
 #     assert df.loc[9627018] is not None
 #     assert int(df.loc[9627018].Price) == 299000
+from localize_be.resources.extract import FastExtractor
 from localize_be.resources.home_cache import HomeCache
+from localize_be.resources.immoweb import MAX_SEARCH_PAGES
+from localize_be.resources.page_archive import PageArchive
 
 SAMPLE_HOME = {"id": 9627018, "property_type": "Home", "city": "Lasnes", "postal_code": "1300", "price": 400000}
 
 
-def test_search_homes():
+def test_search_homes(memory_cache):
     mock_immo = MagicMock()
     mock_immo.search_homes.return_value = [
         SAMPLE_HOME
@@ -56,12 +63,119 @@ def test_get_new_homes():
         assert len(local_cache.get_homes_to_sync()) == 1, "Only new home should be set to sync"
 
 
-def test_get_old_homes():
-    local_cache = HomeCache(":memory:")
-    local_cache.add_home(SAMPLE_HOME, {}, synced=True)
+def test_get_old_homes(memory_cache):
+    memory_cache.add_home(SAMPLE_HOME, {}, synced=True)
     df_search = pd.DataFrame(data=[
         {"id": 111, "city": "Lasnes", "postal_code": "1234", "price": 4444},
     ])
-    with patch("localize_be.tasks.collect_homes.get_home_cache") as get_cache:
-        get_cache.return_value = local_cache
-        assert get_old_homes.run(df_search) == [SAMPLE_HOME["id"]]
+    assert get_old_homes.run(df_search) == [SAMPLE_HOME["id"]]
+
+
+def test_get_new_homes_concurrently(sample_server, immoweb_api, memory_cache):
+    df_search = pd.DataFrame(data=[
+        {"id": i, "property_type": "Home", "city": "Perwez", "postal_code": sample, "price": 1}
+        for i, sample in enumerate(["iw_ad", "iw_ad_2", "iw_ad_3", "missing"])
+    ])
+    sample_server.fail_paths = ["iw_ad_2"]
+    with patch("localize_be.tasks.collect_homes.get_immoweb") as get_immoweb:
+        get_immoweb.return_value = immoweb_api(retries=0)
+        assert get_new_homes.run(df_search) == 2, "Should skip the listings that could not be fetched"
+    assert sorted(sample_server.requests) == ["/iw_ad/perwez/0", "/iw_ad_2/perwez/1", "/iw_ad_3/perwez/2",
+                                              "/missing/perwez/3"]
+    assert len(memory_cache.get_homes_to_geocode()) == 2
+    assert memory_cache.get_fetch_failures() == ([], [1]), "Should wait before trying the failed listing again"
+
+
+def test_get_new_homes_gone(sample_server, immoweb_api, memory_cache):
+    listing = {"id": 3, "property_type": "Home", "city": "Perwez", "postal_code": "missing", "price": 1}
+    # due now, and no longer in the search results
+    memory_cache.add_fetch_failure(listing, "503 Error", -1, -1)
+    with patch("localize_be.tasks.collect_homes.get_immoweb") as get_immoweb:
+        get_immoweb.return_value = immoweb_api(retries=0)
+        assert get_new_homes.run(pd.DataFrame(data=[])) == 0
+    assert sample_server.requests == ["/missing/perwez/3"]
+    assert memory_cache.get_fetch_failures() == ([], []), "Should not try a listing that is gone again"
+
+
+def test_search_homes_incremental(sample_server, immoweb_api, memory_cache):
+    with patch("localize_be.tasks.collect_homes.get_immoweb") as get_immoweb:
+        get_immoweb.return_value = immoweb_api()
+        df = search_homes.run()
+        assert df.attrs["full_sweep"], "Should sweep all the pages on the first run"
+        assert len(sample_server.requests) == MAX_SEARCH_PAGES
+        assert memory_cache.get_search_checkpoint("Home")["newest_id"] == 9611263
+        memory_cache.add_homes([(home, {}) for home in df.drop_duplicates("id").to_dict("records")], synced=True)
+        finish_crawl.run(df)
+
+        sample_server.requests.clear()
+        df = search_homes.run()
+        assert not df.attrs["full_sweep"]
+        assert len(sample_server.requests) == 1, "Should stop after the first page without anything new"
+        assert get_old_homes.run(df) == [], "Should not look for delisted homes without a full sweep"
+        finish_crawl.run(df)
+
+        sample_server.requests.clear()
+        # the sample server returns the same page for all the pages, so the price change is on each of them
+        memory_cache.con.execute("update homes set price=1 where id=?", (int(df.iloc[-1].id),))
+        df = search_homes.run()
+        assert len(sample_server.requests) == 1, "Should stop at the newest listing of the last run"
+        finish_crawl.run(df)
+
+        sample_server.requests.clear()
+        memory_cache.set_search_checkpoint("Home", 1, 1)
+        search_homes.run()
+        assert len(sample_server.requests) == MAX_SEARCH_PAGES, "Should go on paging when a price changed"
+
+
+def test_reextract_homes(memory_cache):
+    archive = PageArchive(":memory:")
+    archive.close = lambda: None
+    with open(os.path.join(SAMPLES, "iw_ad_3.html"), "rb") as f:
+        ad = FastExtractor().classified(f.read())
+    archive.save(444, ad, "Home", "Perwez", "http://localhost/444")
+    # in a format that home_details does not know
+    archive.save(555, {"classified": {}}, "Home", "Perwez", "http://localhost/555")
+    old_details = {"Price": 300000, "Lat": 50.1, "Lng": 4.1, "Geocode": "address", "TotalScore": 600}
+    memory_cache.add_homes([(dict(SAMPLE_HOME, id=444), old_details), (SAMPLE_HOME, {"Code #": 9627018}),
+                            (dict(SAMPLE_HOME, id=555), {"Code #": 555})], synced=True)
+    with patch("localize_be.tasks.collect_homes.get_page_archive") as get_archive:
+        get_archive.return_value = archive
+        assert reextract_homes.run(chunk_size=1) == 1, "Should skip the page that cannot be extracted"
+        memory_cache.set_geocoded_many([444, 9627018, 555])
+        details = dict(memory_cache.get_homes_to_sync())[444]
+        assert details["Garage"] == "Yes"
+        assert {k: details[k] for k in old_details} == old_details, "Should keep the price, location and scores"
+        memory_cache.set_synced_many([444, 9627018, 555])
+        assert reextract_homes.run() == 0, "Should not update the homes that did not change"
+        assert memory_cache.get_homes_to_sync() == [], "Should leave the geocoded homes synced"
+
+
+def test_search_homes_resumes_crawl(sample_server, immoweb_api, memory_cache):
+    with patch("localize_be.tasks.collect_homes.get_immoweb") as get_immoweb:
+        get_immoweb.return_value = immoweb_api(retries=0)
+        sample_server.fail_paths = ["page=3"]
+        with pytest.raises(HTTPError):
+            search_homes.run()
+        sample_server.fail_paths = []
+        sample_server.requests.clear()
+        df = search_homes.run()
+        assert len(sample_server.requests) == MAX_SEARCH_PAGES - 2, "Should not fetch the pages done again"
+        assert df.id.is_unique
+        finish_crawl.run(df)
+        sample_server.requests.clear()
+        assert search_homes.run().attrs["crawl_id"] != df.attrs["crawl_id"]
+        assert sample_server.requests == ["/iw_search?a=1"], "Should start the new crawl from the first page"
+
+
+def test_search_homes_dedup(sample_server, sample_search, immoweb_api, memory_cache):
+    api = immoweb_api(searches={
+        "Home": sample_search(max_pages=2),
+        "Home, larger area": sample_search("a=2", property_type="Home"),
+    })
+    with patch("localize_be.tasks.collect_homes.get_immoweb") as get_immoweb:
+        get_immoweb.return_value = api
+        df = search_homes.run()
+    assert len(sample_server.requests) == 2 + MAX_SEARCH_PAGES
+    assert df.id.is_unique, "Should keep each home once"
+    assert set(df.property_type) == {"Home"}
+    assert memory_cache.get_search_checkpoint("Home, larger area")["newest_id"] == 9611263
@@ -0,0 +1,51 @@
+import os.path
+
+import pytest
+from conftest import SAMPLES
+
+from localize_be.resources.extract import ExtractionError, FallbackExtractor, FastExtractor, SoupExtractor
+
+ADS = ["iw_ad", "iw_ad_2", "iw_ad_3"]
+
+
+def _sample(name):
+    with open(os.path.join(SAMPLES, f"{name}.html"), "rb") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("name", ADS)
+def test_classified_same_as_soup(name):
+    content = _sample(name)
+    ad = FastExtractor().classified(content)
+    assert ad == SoupExtractor().classified(content)
+    assert ad == FastExtractor().classified(content.decode())
+
+
+def test_search_results_same_as_soup():
+    content = _sample("iw_search")
+    results = FastExtractor().search_results(content)
+    assert results == SoupExtractor().search_results(content)
+    assert results[0]["id"] == 9611263
+
+
+def test_fast_path_failure():
+    with pytest.raises(ExtractionError):
+        FastExtractor().classified(b"<html></html>")
+    with pytest.raises(ExtractionError):
+        FastExtractor().search_results(b"<html></html>")
+
+
+class _Broken(FastExtractor):
+    def classified(self, content):
+        raise ExtractionError("broken")
+
+    def search_results(self, content):
+        raise ExtractionError("broken")
+
+
+def test_fallback_on_full_parse():
+    extractor = FallbackExtractor(fast=_Broken())
+    assert extractor.classified(_sample("iw_ad"))["id"] == FastExtractor().classified(_sample("iw_ad"))["id"]
+    assert extractor.search_results(_sample("iw_search"))[0]["id"] == 9611263
+    content = b"<iw-search :results='[{&quot;id&quot;: 1}]'></iw-search>"
+    assert FallbackExtractor().search_results(content) == [{"id": 1}]
@@ -0,0 +1,56 @@
+import os.path
+from unittest.mock import patch
+
+from localize_be.resources.localities import LocalityIndex
+from localize_be.resources.mapquest import Mapquest
+from localize_be.tasks.geocode import geocode_homes
+
+
+def test_geocode_homes(mapquest_server, memory_cache):
+    home = {"Street": "Rue du Culot 2", "Postal code": 1360, "City": "Thorembais"}
+    memory_cache.add_homes([
+        ({"id": 1, "property_type": "Home", "city": "", "postal_code": "", "price": 1}, home),
+        ({"id": 2, "property_type": "Home", "city": "", "postal_code": "", "price": 1}, dict(home, Street="unknown")),
+    ])
+    with patch("localize_be.tasks.geocode.get_mapquest") as get_mapquest:
+        get_mapquest.return_value = Mapquest("key", base_url=mapquest_server.url)
+        assert geocode_homes.run() == 1
+    assert len(mapquest_server.requests) == 1
+    assert [id_ for id_, _ in memory_cache.get_homes_to_geocode()] == [2], "Should leave the home not found to geocode"
+    assert memory_cache.get_homes_to_sync()[0][1]["Lat"] is not None
+    assert memory_cache.get_geocode_waiting() == [2]
+    with patch("localize_be.tasks.geocode.get_mapquest") as get_mapquest:
+        assert geocode_homes.run() == 0
+    assert not get_mapquest.called, "Should wait before trying the home not found again"
+
+
+def test_geocode_homes_failed_batch(mapquest_server, memory_cache):
+    home = {"Street": "Rue de l'error 2", "Postal code": 1360, "City": "Thorembais"}
+    memory_cache.add_homes([({"id": 1, "property_type": "Home", "city": "", "postal_code": "", "price": 1}, home)])
+    with patch("localize_be.tasks.geocode.get_mapquest") as get_mapquest:
+        get_mapquest.return_value = Mapquest("key", base_url=mapquest_server.url)
+        assert geocode_homes.run() == 0
+    assert memory_cache.get_geocode_waiting() == [], "Should not back off when Mapquest fails"
+    assert [id_ for id_, _ in memory_cache.get_homes_to_geocode()] == [1]
+
+
+def test_geocode_tiers(mapquest_server, memory_cache):
+    data = {"property_type": "Home", "city": "", "postal_code": "", "price": 1}
+    home = {"Street": "", "Postal code": 1370, "City": "Jodoigne", "Lat": None, "Lng": None}
+    memory_cache.add_homes([
+        (dict(data, id=1), dict(home, Lat=50.1, Lng=4.1)),
+        (dict(data, id=2), home),
+        (dict(data, id=3), dict(home, City="Nowhere")),
+        (dict(data, id=4), dict(home, Street="Rue du Culot 2")),
+    ])
+    localities = LocalityIndex.from_csv(os.path.join(os.path.dirname(__file__), "..", "geocodes.csv"))
+    with patch("localize_be.tasks.geocode.get_mapquest") as get_mapquest, patch(
+            "localize_be.tasks.geocode.get_locality_index") as get_locality_index:
+        get_mapquest.return_value = Mapquest("key", base_url=mapquest_server.url)
+        get_locality_index.return_value = localities
+        assert geocode_homes.run() == 4
+    assert mapquest_server.requests == [["1370 Nowhere, Belgium", "Rue du Culot 2, 1370 Jodoigne, Belgium"]]
+    homes = dict(memory_cache.get_homes_to_sync())
+    assert (homes[1]["Lat"], homes[1]["Geocode"]) == (50.1, "listing"), "Should keep the location of the listing"
+    assert (homes[2]["Lat"], homes[2]["Lng"]) == localities.get("JODOIGNE")
+    assert [homes[i]["Geocode"] for i in range(2, 5)] == ["locality", "locality", "address"]
@@ -10,7 +10,7 @@ def test_do_geocode():
         f.write(b"School;3;Rue du Culot 2, 1360 Thorembais-Saint-Trond\n")
         f.flush()
         mock_mapquest = MagicMock()
-        mock_mapquest.geocode.return_value = (1, 2)
+        mock_mapquest.geocode_many.return_value = [(1, 2, "ADDRESS")]
         with patch("localize_be.tasks.get_pois.get_mapquest") as get_mapquest:
             get_mapquest.return_value = mock_mapquest
             pois = get_pois.run(path=f.name)
@@ -0,0 +1,131 @@
+import sqlite3
+import tempfile
+
+import pytest
+
+from localize_be.resources.home_cache import HomeCache, MIGRATIONS
+
+
+def make_home(id_):
+    return {"id": id_, "property_type": "Home", "city": "Perwez", "postal_code": "1360", "price": 300000}, {
+        "Code #": id_, "Lat": 50.6, "Lng": 4.8
+    }
+
+
+def test_bulk_writes():
+    cache = HomeCache(":memory:")
+    cache.add_homes([make_home(1), make_home(2), make_home(3)])
+    cache.set_geocoded_many([1, 2, 3])
+    assert len(cache.get_homes_to_sync()) == 3
+    cache.set_synced_many([1, 2])
+    assert [id_ for id_, _ in cache.get_homes_to_sync()] == [3]
+    cache.update_homes([(1, {"Code #": 1, "Price": 1})])
+    assert dict(cache.get_homes_to_sync())[1] == {"Code #": 1, "Price": 1}
+
+
+def test_transaction_commits_once():
+    with tempfile.NamedTemporaryFile() as f:
+        cache = HomeCache(f.name)
+        with cache.transaction():
+            cache.add_home(*make_home(1))
+            with cache.transaction():
+                cache.add_home(*make_home(2))
+            assert cache.con.in_transaction
+            assert HomeCache(f.name).get_homes_to_geocode() == [], "Should not be committed yet"
+        assert len(HomeCache(f.name).get_homes_to_geocode()) == 2
+
+
+def test_transaction_rollback():
+    cache = HomeCache(":memory:")
+    with pytest.raises(ValueError):
+        with cache.transaction():
+            cache.add_home(*make_home(1))
+            raise ValueError()
+    assert cache.get_homes_to_geocode() == []
+
+
+def test_migrate_existing_cache():
+    with tempfile.NamedTemporaryFile() as f:
+        con = sqlite3.connect(f.name)
+        con.execute("""
+        create table homes (
+            id int primary key, city text, postal_code text, price int, 
+            property_type text, synced int default 0, geocoded int default 0, 
+            details text
+        )
+        """)
+        con.execute("""insert into homes (id, details, geocoded) values (1, '{"Lat": 50.5, "TotalScore": 600}', 1)""")
+        con.execute("insert into homes (id, details) values (2, '{}')")
+        con.commit()
+        cache = HomeCache(f.name)
+        assert cache.con.execute("pragma user_version").fetchone()[0] == len(MIGRATIONS)
+        assert cache.con.execute("select lat, total_score, has_details from homes where id=1").fetchone() == (
+            50.5, 600, 1)
+        assert [row["id"] for row in cache.get_homes_missing_details()] == [2]
+        assert [id_ for id_, _ in cache.get_homes_geocoded()] == [1]
+        HomeCache(f.name)
+
+
+def test_typed_columns_follow_details():
+    cache = HomeCache(":memory:")
+    cache.add_home(*make_home(1))
+    assert cache.con.execute("select lat, has_details from homes").fetchone() == (50.6, 1)
+    cache.update_home(1, {"Lat": 51, "Bedrooms": 4})
+    assert cache.con.execute("select lat, bedrooms from homes").fetchone() == (51, 4)
+    plan = " ".join(row[3] for row in cache.con.execute(
+        "explain query plan select id, details from homes where geocoded=1 and synced=0 and has_details=1"))
+    assert "homes_to_sync" in plan
+
+
+def test_iter_homes_streams():
+    cache = HomeCache(":memory:")
+    cache.add_homes([make_home(i) for i in range(5)])
+    cache.add_home(dict(make_home(10)[0]), {})
+    homes = cache.iter_homes_to_geocode(chunk_size=2)
+    assert next(homes) == (0, make_home(0)[1])
+    assert [id_ for id_, _ in homes] == [1, 2, 3, 4]
+    assert [row["id"] for row in cache.iter_homes_missing_details()] == [10]
+    assert cache.con.row_factory is None, "Should not change the row factory of the connection"
+
+
+def test_iter_homes_while_updating():
+    cache = HomeCache(":memory:")
+    cache.add_homes([make_home(i) for i in range(7)])
+    cache.set_geocoded_many(list(range(7)))
+    seen = []
+    for id_, _ in cache.iter_homes_to_sync(chunk_size=2):
+        seen.append(id_)
+        # moves the home out of the partial index that is streamed
+        cache.set_synced(id_)
+    assert seen == list(range(7)), "Should stream each home once"
+
+
+def test_price_changes():
+    cache = HomeCache(":memory:")
+    cache.add_homes([make_home(1), make_home(2)], synced=True)
+    cache.set_geocoded_many([1, 2])
+    cache.set_score_fingerprints({1: "abc", 2: "abc"})
+    classified = cache.classify_listings([
+        {"id": 1, "price": 300000}, {"id": 2, "price": 280000}, {"id": 3, "price": 1}, {"id": 3, "price": 1}
+    ])
+    assert [[listing["id"] for listing in classified[c]] for c in ["new", "price_changed", "unchanged"]] == [
+        [3], [2], [1]]
+    cache.update_prices([(2, 280000)])
+    assert [(id_, details.get("Price")) for id_, details in cache.get_homes_to_sync()] == [(2, 280000)]
+    assert cache.get_score_fingerprints([1, 2]) == {1: "abc"}, "Should be rescored"
+    assert [price for price, _ in cache.get_price_history(2)] == [300000, 280000]
+    cache.add_home(*make_home(2))
+    assert [price for price, _ in cache.get_price_history(2)] == [300000, 280000, 300000]
+    cache.add_home(*make_home(2))
+    assert len(cache.get_price_history(2)) == 3, "Should only record the changes"
+
+
+def test_abandoned_crawl_pages_purged():
+    cache = HomeCache(":memory:")
+    journal = cache.start_crawl(True, 3600)
+    journal.set_page("Home", 1, [{"id": 1}])
+    # too old to be resumed
+    cache.con.execute("update crawls set started_at=0")
+    new_journal = cache.start_crawl(False, 3600)
+    assert new_journal.crawl_id != journal.crawl_id
+    assert cache.get_crawl_page(journal.crawl_id, "Home", 1) is None, "Should drop the pages of the abandoned crawl"
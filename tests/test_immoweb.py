@@ -1,9 +1,18 @@
+import json
+import os.path
+import time
 from unittest.mock import patch, PropertyMock, MagicMock
 
+import prefect
 import pytest
-from requests import Session
+from conftest import SAMPLES
+from requests import HTTPError, Session, Timeout
 
-from localize_be.resources.immoweb import ImmowebAPI
+from localize_be.resources.concurrency import CircuitOpenError, RateLimiter
+from localize_be.resources.http_cache import HttpCache
+from localize_be.resources.immoweb import (BREAKER_FAILURES, SEARCHES, ImmowebAPI, SearchConfig, load_searches,
+                                           MAX_SEARCH_PAGES, get_immoweb, home_details)
+from localize_be.resources.page_archive import PageArchive, decompress
 
 test_ads = {
     "iw_ad": {"Price": 215000},
@@ -16,11 +25,11 @@ test_ads = {
 @patch.object(Session, 'get')
 def test_get_home(mock_get, ad):
     name, data_to_check = ad
-    with open(f"./samples/{name}.html") as f:
+    with open(os.path.join(SAMPLES, f"{name}.html")) as f:
         content = MagicMock()
         type(content).content = PropertyMock(return_value=f.read())
         mock_get.return_value = content
-    iw = ImmowebAPI(get_delay_range=(0, 1))
+    iw = ImmowebAPI(requests_per_minute=0)
     home = iw.get_home(444, "Home", name, 6990)
     for k, v in data_to_check.items():
         assert home[k] == v
@@ -28,11 +37,11 @@ def test_get_home(mock_get, ad):
 
 @patch.object(Session, 'get')
 def test_search_homes(mock_get):
-    with open("./samples/iw_search.html") as f:
+    with open(os.path.join(SAMPLES, "iw_search.html")) as f:
         content = MagicMock()
         type(content).content = PropertyMock(return_value=f.read())
         mock_get.return_value = content
-    iw = ImmowebAPI(get_delay_range=(0, 1))
+    iw = ImmowebAPI(requests_per_minute=0)
     homes = list(iw.search_homes())
     assert len(homes) > 4
     assert homes[0] == {
@@ -40,5 +49,126 @@ def test_search_homes(mock_get):
         "city": "Perwez",
         "postal_code": "1360",
         "price": 360000,
-        "property_type": "Home"
+        "property_type": "Home",
+        "search": "Home"
     }
+
+
+def test_get_home_from_server(sample_server, immoweb_api):
+    iw = immoweb_api()
+    home = iw.get_home(444, "Home", "Perwez", "iw_ad_3")
+    assert home["Price"] == 319000
+    assert home["Link.Url"] == f"http://127.0.0.1:{sample_server.server_port}/iw_ad_3/perwez/444"
+    assert len(list(iw.search_homes())) > 4 * MAX_SEARCH_PAGES
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(per_minute=600, jitter=0)
+    start = time.monotonic()
+    for _ in range(4):
+        limiter.wait()
+    assert time.monotonic() - start >= 0.3
+
+
+def test_connections_reused(immoweb_api):
+    iw = immoweb_api(max_in_flight=2)
+    for sample in ["iw_ad", "iw_ad_2", "iw_ad_3"]:
+        iw.get_home(444, "Home", "Perwez", sample)
+    assert iw.connection_stats() == {"opened": 1, "reused": 2}
+    iw.close()
+
+
+@patch("localize_be.resources.immoweb.get_page_archive", MagicMock())
+@patch("localize_be.resources.immoweb.get_http_cache", MagicMock())
+def test_get_immoweb_per_run():
+    with prefect.context(flow_run_id="run-1"):
+        api = get_immoweb()
+        assert get_immoweb() is api
+    with prefect.context(flow_run_id="run-2"):
+        assert get_immoweb() is not api
+
+
+def test_archive_and_reextract(immoweb_api):
+    archive = PageArchive(":memory:")
+    iw = immoweb_api(archive=archive)
+    home = iw.get_home(444, "Home", "Perwez", "iw_ad_3")
+    iw.get_home(444, "Home", "Perwez", "iw_ad_3")
+    assert archive.con.execute("select count(*) from payloads").fetchone()[0] == 1, "Should store a payload once"
+    latest = list(archive.iter_latest())
+    assert len(latest) == 1
+    home_id, property_type, locality, url, data = latest[0]
+    assert home_details(decompress(data), property_type, locality, url) == home
+
+
+@pytest.mark.parametrize("etags", [True, False])
+def test_http_cache(sample_server, etags, immoweb_api):
+    sample_server.etags = etags
+    iw = immoweb_api(http_cache=HttpCache(":memory:", 1024 * 1024))
+    iw.extractor = MagicMock(wraps=iw.extractor)
+    home = iw.get_home(444, "Home", "Perwez", "iw_ad_3")
+    assert iw.get_home(444, "Home", "Perwez", "iw_ad_3") == home
+    assert iw.extractor.classified.call_count == 1, "Should not extract an unchanged page again"
+    assert iw.cache_stats == {"miss": 1, "not_modified" if etags else "unchanged": 1}
+
+
+def test_http_cache_eviction():
+    cache = HttpCache(":memory:", 100)
+    cache.put("a", None, None, "hash", list(range(10)))
+    cache.put("b", None, None, "hash", list(range(10)))
+    assert cache.get("a") is not None
+    cache.put("c", None, None, "hash", list(range(10)))
+    assert cache.get("b") is None, "Should evict the least recently used"
+    assert cache.get("a") == list(range(10))
+    assert cache.get("a", "other hash") is None
+
+
+def test_retry_with_backoff(sample_server, immoweb_api):
+    iw = immoweb_api(retries=2, backoff=0.01)
+    sample_server.fail_next = 2
+    assert iw.get_home(444, "Home", "Perwez", "iw_ad_3")["Price"] == 319000
+    assert len(sample_server.requests) == 3
+    sample_server.fail_next = 3
+    with pytest.raises(HTTPError):
+        iw.get_home(444, "Home", "Perwez", "iw_ad_3")
+
+
+def test_long_retry_after(sample_server, immoweb_api):
+    iw = immoweb_api(retries=2, backoff=0.01)
+    sample_server.fail_next = 1
+    sample_server.retry_after = "3600"
+    start = time.time()
+    with pytest.raises(HTTPError):
+        iw.get_home(444, "Home", "Perwez", "iw_ad_3")
+    assert time.time() - start < 5, "Should fail instead of waiting an hour"
+    assert len(sample_server.requests) == 1
+
+
+def test_timeout(silent_server, immoweb_api):
+    search = SearchConfig(search_url=f"{silent_server}/iw_search", home_url=silent_server + "/{1}/{0}/{2}")
+    iw = immoweb_api(retries=1, backoff=0.01, timeout=(1, 0.2), searches={"Home": search})
+    start = time.time()
+    with pytest.raises(Timeout):
+        iw.get_home(444, "Home", "Perwez", "iw_ad_3")
+    assert time.time() - start < 5, "Should not wait for the stalled connection"
+
+
+def test_circuit_breaker(sample_server, immoweb_api):
+    iw = immoweb_api(retries=0)
+    sample_server.fail_paths = ["iw_ad_3"]
+    for _ in range(BREAKER_FAILURES):
+        with pytest.raises(HTTPError):
+            iw.get_home(444, "Home", "Perwez", "iw_ad_3")
+    with pytest.raises(CircuitOpenError):
+        iw.get_home(444, "Home", "Perwez", "iw_ad")
+    assert len(sample_server.requests) == BREAKER_FAILURES, "Should not send requests while the circuit is open"
+
+
+def test_load_searches(tmp_path):
+    path = tmp_path / "searches.json"
+    path.write_text(json.dumps({"Land": {"property_type": "Land", "postal_codes": [1360, 5031], "max_price": 1000}}))
+    searches = load_searches(str(path))
+    assert searches["Land"].search_url == (
+        "https://www.immoweb.be/fr/recherche/terrain-a-batir/a-vendre?countries=BE&postalCodes=BE-1360,BE-5031"
+        "&maxPrice=1000&priceType=PRICE&orderBy=newest")
+    assert searches["Land"].home_url.startswith("https://www.immoweb.be/fr/annonce/terrain-a-batir/")
+    assert load_searches(None) == SEARCHES
@@ -1,14 +1,91 @@
+from unittest.mock import patch
+
+import pytest
+from requests import HTTPError, Timeout
+
 from localize_be.config import config
-from localize_be.resources.mapquest import Mapquest
+from localize_be.resources.geocode_cache import GeocodeCache, normalize_address
+from localize_be.resources.mapquest import BATCH_SIZE, Mapquest, QuotaExceededError
+
 
+live = pytest.mark.skipif(not config["MAPQUEST"]["API_KEY"], reason="needs a Mapquest API key")
 
+
+@live
 def test_geocode_simple():
     m = Mapquest(config["MAPQUEST"]["API_KEY"])
     ll = m.geocode("4 rue Doucet, 1370 Dongelberg")
     assert ll == (50.70128, 4.82279)
 
 
+@live
 def test_geocode_by_city_with_zip():
     m = Mapquest(config["MAPQUEST"]["API_KEY"])
     ll = m.geocode("1360 MALÈVES-SAINTE-MARIE-WASTINNES")
     assert ll == (50.65833, 4.792)
+
+
+def test_geocode_cache(mapquest_server):
+    m = Mapquest("key", GeocodeCache(":memory:", ttl=3600), base_url=mapquest_server.url)
+    lat, lng = m.geocode("4 rue Doucet, 1370 Dongelberg")
+    assert m.geocode_with_quality("4 Rue Doucet 1370  DONGELBERG") == (lat, lng, "ADDRESS")
+    assert len(mapquest_server.requests) == 1, "Should find the address in the cache"
+
+
+def test_geocode_cache_expiry(mapquest_server):
+    m = Mapquest("key", GeocodeCache(":memory:", ttl=-1), base_url=mapquest_server.url)
+    m.geocode("4 rue Doucet, 1370 Dongelberg")
+    m.geocode("4 rue Doucet, 1370 Dongelberg")
+    assert len(mapquest_server.requests) == 2, "Should not use expired entries"
+
+
+def test_geocode_many(mapquest_server):
+    m = Mapquest("key", base_url=mapquest_server.url)
+    addresses = [f"{i} rue Doucet, 1370 Dongelberg" for i in range(BATCH_SIZE + 10)]
+    addresses += ["unknown street", addresses[0].upper()]
+    results = m.geocode_many(addresses)
+    assert results[0][2] == "ADDRESS"
+    assert [len(batch) for batch in mapquest_server.requests] == [BATCH_SIZE, 11], "Should send each address once"
+    assert results[0] == results[-1] == m.geocode_with_quality(addresses[0])
+    assert len(set(results[:BATCH_SIZE + 10])) == BATCH_SIZE + 10, "Should map the results back to the addresses"
+    assert isinstance(results[-2], LookupError)
+
+
+def test_geocode_many_failed_batch(mapquest_server):
+    m = Mapquest("key", base_url=mapquest_server.url)
+    with patch("localize_be.resources.mapquest.BATCH_SIZE", 2):
+        results = m.geocode_many(["1 rue Doucet", "error", "2 rue Doucet"])
+    assert isinstance(results[0], HTTPError) and isinstance(results[1], HTTPError)
+    assert not isinstance(results[2], Exception), "Should geocode the other batches"
+
+
+def test_geocode_many_quota(mapquest_server):
+    cache = GeocodeCache(":memory:", ttl=3600)
+    m = Mapquest("key", cache, base_url=mapquest_server.url, max_in_flight=4, daily_quota=5)
+    with patch("localize_be.resources.mapquest.BATCH_SIZE", 2):
+        results = m.geocode_many([f"{i} rue Doucet, 1370 Dongelberg" for i in range(6)])
+        assert sum(isinstance(r, QuotaExceededError) for r in results) == 2, "Should stop at the quota"
+        assert cache.used_today() == 4
+        assert m.geocode_many(["1 rue Doucet, 1370 Dongelberg"]) == [results[1]], "Should still use the cache"
+    assert len(mapquest_server.requests) == 2
+
+
+def test_geocode_many_quota_released():
+    cache = GeocodeCache(":memory:", ttl=3600)
+    # nothing listens on that port
+    m = Mapquest("key", cache, base_url="http://127.0.0.1:9", daily_quota=5)
+    results = m.geocode_many(["1 rue Doucet, 1370 Dongelberg"])
+    assert isinstance(results[0], Exception)
+    assert cache.used_today() == 0, "Should give back the quota of a batch that was not sent"
+
+
+def test_normalize_address():
+    assert normalize_address("1360 MALÈVES-SAINTE-MARIE-WASTINNES") == "1360 maleves sainte marie wastinnes"
+
+
+def test_geocode_many_timeout(silent_server):
+    cache = GeocodeCache(":memory:", ttl=3600)
+    m = Mapquest("key", cache, base_url=silent_server, daily_quota=5, timeout=(1, 0.2))
+    results = m.geocode_many(["1 rue Doucet, 1370 Dongelberg"])
+    assert isinstance(results[0], Timeout)
+    assert cache.used_today() == 0
@@ -0,0 +1,102 @@
+from unittest.mock import patch
+
+import pandas as pd
+import pytest
+
+from localize_be.core import profile
+from localize_be.core.ranking import HomeRanking
+from localize_be.resources.home_cache import HomeCache
+from localize_be.tasks import score_homes
+from localize_be.tasks.score_homes import score_all
+
+POIS = pd.DataFrame([
+    {"Category": "School", "Weight": 10, "Address": "Rue du Culot 2", "Lat": 50.63604, "Lng": 4.78471},
+    {"Category": "AV", "Weight": 1, "Address": "Avenue Louise 1", "Lat": 50.86587, "Lng": 4.42057}
+])
+
+
+def make_home(id_, lat, lng):
+    return {"id": id_, "property_type": "Home", "city": "Perwez", "postal_code": "1360", "price": 300000}, {
+        "Lat": lat, "Lng": lng, "Attic": "No", "Basement": "No", "Garage": "No", "Office": "No",
+        "Bedrooms": 3, "SqMeter": 200
+    }
+
+
+def add_homes(cache, *homes):
+    for data, details in homes:
+        cache.add_home(data, details)
+        cache.set_geocoded(data["id"])
+
+
+def test_get_distances_reads_cache():
+    cache = HomeCache(":memory:")
+    add_homes(cache, make_home(1, 50.5, 4.7), make_home(2, 50.86, 4.42))
+    homes = cache.get_homes_geocoded()
+    distances = cache.get_distances(homes, POIS)
+    assert distances.shape == (2, 2)
+    assert round(distances[0, 0]) == 16
+    cache.con.execute("update distances set distance = 1234 where home_id = 2")
+    assert list(cache.get_distances(homes, POIS)[1]) == [1234, 1234], "Should read the distances from cache"
+
+
+def test_get_distances_recomputes_moved():
+    cache = HomeCache(":memory:")
+    add_homes(cache, make_home(1, 50.5, 4.7))
+    homes = cache.get_homes_geocoded()
+    cache.get_distances(homes, POIS)
+    cache.con.execute("update distances set distance = 1234")
+    homes[0][1]["Lat"] = 50.6
+    moved_pois = POIS.copy()
+    moved_pois.loc[1, "Lat"] = 50.7
+    distances = cache.get_distances(homes, moved_pois)
+    assert 1234 not in distances
+
+
+def test_rank_with_other_weights():
+    cache = HomeCache(":memory:")
+    add_homes(cache, make_home(1, 50.63, 4.78), make_home(2, 50.86, 4.42))
+    ranking = HomeRanking.from_cache(cache, POIS)
+    assert list(ranking.rank().index) == [1, 2], "Home 1 is next to the school, which has the highest weight"
+    assert list(ranking.rank(weights={"AV": 100}).index) == [2, 1]
+    assert list(ranking.rank(weights={"School|Rue du Culot 2": 0}).index) == [2, 1]
+
+
+def test_score_all(memory_cache):
+    add_homes(memory_cache, make_home(1, 50.63, 4.78), make_home(2, 50.86, 4.42))
+    data, details = make_home(3, 0, 0)
+    memory_cache.add_home(data, dict(details, Lat=None, Lng=None))
+    memory_cache.set_geocoded(3)
+    score_all.run(POIS, rescore=True)
+    scores = {id_: d.get("TotalScore") for id_, d in memory_cache.get_homes_geocoded()}
+    assert scores[1] > scores[2]
+    assert scores[3] is None
+    expected = HomeRanking.from_cache(memory_cache, POIS).rank()
+    assert scores[1] == pytest.approx(expected.loc[1].TotalScore)
+
+
+def test_rescore_skips_unchanged(memory_cache):
+    add_homes(memory_cache, make_home(1, 50.63, 4.78), make_home(2, 50.86, 4.42))
+    with patch.object(score_homes, "CHUNK_SIZE", 1):
+        score_all.run(POIS, rescore=True)
+        for id_, _ in memory_cache.get_homes_to_sync():
+            memory_cache.set_synced(id_)
+        score_all.run(POIS, rescore=True)
+        assert memory_cache.get_homes_to_sync() == [], "Nothing changed, homes should stay synced"
+        pois = POIS.copy()
+        pois.loc[1, "Weight"] = 5
+        score_all.run(pois, rescore=True)
+        assert len(memory_cache.get_homes_to_sync()) == 2
+
+
+def test_score_all_profiles(memory_cache):
+    add_homes(memory_cache, make_home(1, 50.63, 4.78), make_home(2, 50.86, 4.42))
+    av_pois = POIS.iloc[[1]].reset_index(drop=True)
+    profiles = {"av": profile.compile_profile(dict(profile.DEFAULT_PROFILE, sheet={"tab": "AV", "gid": "1"}), "av")}
+    with patch("localize_be.tasks.score_homes.get_scoring_profiles") as get_profiles:
+        get_profiles.return_value = profiles
+        score_all.run(POIS, rescore=True, profile_pois={"av": av_pois})
+    av_homes = dict(memory_cache.get_profile_homes_to_sync("av"))
+    assert av_homes[2]["TotalScore"] > av_homes[1]["TotalScore"], "Home 2 is the closest to AV"
+    assert "dist.School" not in av_homes[1], "Should not have the default profile scores"
+    default_homes = dict(memory_cache.get_homes_to_sync())
+    assert default_homes[1]["TotalScore"] > default_homes[2]["TotalScore"]
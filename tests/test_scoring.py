@@ -1,6 +1,11 @@
+import json
+
+import numpy as np
 import pandas as pd
+import pytest
 
-from localize_be.core import scoring
+from localize_be.core import profile, scoring
+from localize_be.core.spatial import PoiIndex
 
 
 def test_calculate_distance():
@@ -68,3 +73,95 @@ def test_calculate_distances_for_pois():
     assert "dist.School" in d, "Should save distance for POIS"
     assert round(d["dist.School"], 0) == 16
     assert round(d["dist.AV"], 0) == 45
+
+
+@pytest.mark.parametrize("nearest", [{}, {"School": 3, "AV": 1}])
+def test_calculate_scores_same_as_calculate_score(nearest):
+    pois = pd.DataFrame([
+        {"Category": "School", "Weight": 12, "Lat": 50.63604, "Lng": 4.78471},
+        {"Category": "School", "Weight": 2, "Lat": 50.2, "Lng": 4.5},
+        {"Category": "AV", "Weight": 3, "Lat": 50.86587, "Lng": 4.42057}
+    ])
+    scoring_profile = profile.compile_profile(dict(profile.DEFAULT_PROFILE, nearest=nearest))
+    homes = [
+        {"Lat": 50.5, "Lng": 4.7, "Attic": "No", "Basement": "Yes", "Garage": "No", "Office": "No",
+         "Bedrooms": 3, "SqMeter": 200},
+        {"Lat": 50.7, "Lng": 4.6, "Attic": "Yes", "Basement": "No", "Garage": "Yes", "Office": "Yes",
+         "Bedrooms": None, "SqMeter": None},
+    ]
+    expected = [scoring.calculate_score(dict(d), pois, scoring_profile) for d in homes]
+    result = scoring.calculate_scores([dict(d) for d in homes], pois, scoring_profile)
+    assert len(result) == 2
+    for r, e in zip(result, expected):
+        assert r.keys() == e.keys()
+        for k, v in e.items():
+            assert r[k] == pytest.approx(v), k
+
+
+def test_compile_linear_curve():
+    curve = profile.compile_curve({"fit": "linear", "points": [[0, 10], [10, 30], [20, 50]]})
+    assert curve.slope == pytest.approx(2)
+    assert curve.intercept == pytest.approx(10)
+    assert list(curve(np.array([5, 15]))) == pytest.approx([20, 40])
+
+
+def test_compile_piecewise_curve():
+    curve = profile.compile_curve({"fit": "piecewise", "points": [[10, 0], [0, 100], [20, 50]]})
+    assert list(curve(np.array([-5, 5, 15, 30]))) == pytest.approx([100, 50, 25, 50])
+
+
+def test_load_profile(tmp_path):
+    path = tmp_path / "scoring.json"
+    # the other keys are taken from the default profile
+    path.write_text(json.dumps({"features": {"Pool": 100}}))
+    pool_profile = profile.load_profile(str(path))
+    assert pool_profile.version != profile.load_profile().version
+    full_spec = dict(profile.DEFAULT_PROFILE, features={"Pool": 100})
+    assert pool_profile.version == profile.compile_profile(full_spec).version
+    d = {
+        "Lat": 50.63601,
+        "Lng": 4.78473,
+        "Attic": "Yes",
+        "Pool": "Yes",
+        "Office": "No",
+        "Bedrooms": 3,
+        "SqMeter": 200
+    }
+    pois = pd.DataFrame([
+        {"Category": "School", "Weight": 12, "Lat": 50.63604, "Lng": 4.78471}
+    ])
+    with_pool = scoring.calculate_score(dict(d), pois, pool_profile)["TotalScore"]
+    without_pool = scoring.calculate_score(dict(d, Pool="No"), pois, pool_profile)["TotalScore"]
+    assert with_pool - without_pool == pytest.approx(100)
+
+
+def test_nearest_by_category():
+    pois = pd.DataFrame([
+        {"Category": "School", "Weight": 1, "Lat": 50.63604, "Lng": 4.78471},
+        {"Category": "School", "Weight": 1, "Lat": 50.2, "Lng": 4.5},
+        {"Category": "AV", "Weight": 1, "Lat": 50.86587, "Lng": 4.42057}
+    ])
+    index = PoiIndex(pois, cell_km=1)
+    distances, positions = index.nearest(np.array([50.5, 50.25]), np.array([4.7, 4.5]), "School", k=2)
+    assert positions.tolist() == [[0, 1], [1, 0]]
+    assert round(distances[0, 0]) == 16
+    nearest = index.nearest_by_category(np.array([50.5]), np.array([4.7]))
+    assert round(nearest["School"][0]) == 16
+    assert round(nearest["AV"][0]) == 45
+
+
+def test_calculate_scores_nearest():
+    pois = pd.DataFrame([
+        {"Category": "School", "Weight": 1, "Lat": 50.63604, "Lng": 4.78471},
+        {"Category": "School", "Weight": 1, "Lat": 50.2, "Lng": 4.5},
+        {"Category": "AV", "Weight": 1, "Lat": 50.86587, "Lng": 4.42057}
+    ])
+    d = {"Lat": 50.5, "Lng": 4.7, "Attic": "No", "Basement": "No", "Garage": "No", "Office": "No",
+         "Bedrooms": 3, "SqMeter": 200}
+    nearest_profile = profile.compile_profile(dict(profile.DEFAULT_PROFILE, nearest={"School": 3, "AV": 1}))
+    expected = scoring.calculate_score(dict(d), pois, nearest_profile)
+    assert round(expected["dist.min.School"]) == 16
+    assert expected["dist.Total"] == pytest.approx((expected["dist.min.School"] * 3 + expected["dist.min.AV"]) / 4)
+    result = scoring.calculate_scores([dict(d)], pois, nearest_profile)[0]
+    for k in ("dist.min.School", "dist.min.AV", "dist.Total", "TotalScore"):
+        assert result[k] == pytest.approx(expected[k]), k
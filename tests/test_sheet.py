@@ -1,8 +1,11 @@
 import os.path
+from unittest.mock import patch
 
 import pytest
 
-from localize_be.resources.sheet import Sheet
+from localize_be.resources.sheet import Sheet, _chunks, _column
+from localize_be.resources.sheet_state import SheetState
+from localize_be.tasks.sync import sync_new
 
 
 @pytest.fixture
@@ -36,3 +39,110 @@ def test_update_homes(svc):
 
 def test_set_filter(svc):
     svc.set_home_filter([9461808])
+
+
+def grid_data(rows):
+    """Answer of spreadsheets().get for the rows of values"""
+    return {"rowData": [{"values": [
+        {"effectiveValue": {"numberValue" if isinstance(v, (int, float)) else "stringValue": v}} if v != "" else {}
+        for v in row]} for row in rows]}
+
+
+def sheet_metadata(ids, row_count=4):
+    return {"sheets": [{
+        "properties": {"gridProperties": {"rowCount": row_count, "columnCount": 26}},
+        "basicFilter": {"filterSpecs": [{"columnIndex": 0, "filterCriteria": {"hiddenValues": ["3"]}}]},
+        "data": [grid_data([["Code #", "Price", "Image", "Energy", "Bedrooms", ""]]), grid_data(ids)]
+    }]}
+
+
+@pytest.fixture
+def offline_svc():
+    with patch("localize_be.resources.sheet.build_service") as build_service:
+        sheets = build_service.return_value
+        sheets.get.return_value.execute.return_value = sheet_metadata([[1], [2], [], [3]])
+        yield Sheet("id", "gid", state=SheetState(":memory:"))
+
+
+def test_update_homes_diff(offline_svc):
+    existing = [(0, {"id": 1}), (1, {"id": 2}), (3, {"id": 3})]
+    homes = [{"Code #": 1, "Price": 100, "Energy": "E", "Bedrooms": 3},
+             {"Code #": 2, "Price": 200, "Energy": "C", "Bedrooms": 4}]
+    assert offline_svc.update_homes(existing, homes) == 2
+    batch_update = offline_svc.sheets.values.return_value.batchUpdate
+    data = batch_update.call_args.kwargs["body"]["data"]
+    assert data[0] == {"range": "'Houses'!A2:E2", "values": [[1, 100, None, "E", 3]]}
+
+    batch_update.reset_mock()
+    homes[1] = dict(homes[1], Price=190, Bedrooms=5)
+    assert offline_svc.update_homes(existing, homes) == 1
+    data = batch_update.call_args.kwargs["body"]["data"]
+    assert data == [{"range": "'Houses'!B3:E3", "values": [[190, None, None, 5]]}], "Should only send the changes"
+
+    batch_update.reset_mock()
+    assert offline_svc.update_homes(existing, homes) == 0
+    assert not batch_update.called
+
+
+def test_layout(offline_svc):
+    layout = offline_svc.layout()
+    assert (layout.headers, layout.rows, layout.hidden) == (
+        ["Code #", "Price", "Image", "Energy", "Bedrooms"], {1: 0, 2: 1, 3: 3}, ["3"])
+    offline_svc.layout()
+    assert offline_svc.sheets.get.return_value.execute.call_count == 1, "Should read the layout once"
+
+    # sorted in the sheet, with an id entered as text
+    offline_svc.sheets.get.return_value.execute.return_value = sheet_metadata([[3], [" 2"], [1], ["Total"]])
+    svc = Sheet("id", "gid", state=offline_svc.state)
+    assert svc.layout().rows == {3: 0, 2: 1, 1: 2}
+    svc.upsert_homes([{"Code #": 1, "Price": 90}])
+    data = svc.sheets.values.return_value.batchUpdate.call_args.kwargs["body"]["data"]
+    assert data == [{"range": "'Houses'!A4:B4", "values": [[1, 90]]}], "Should write the row where the home is now"
+    svc.set_home_filter([3])
+    assert not svc.sheets.batchUpdate.called, "Should not set the same filter again"
+
+
+def test_add_homes_after_last_row(offline_svc):
+    offline_svc.sheets.get.return_value.execute.return_value = sheet_metadata([[1], [2], ["3"], ["Total"]], 10)
+    offline_svc.upsert_homes([{"Code #": 4, "Price": 100, "Street": "", "City": "Perwez"}])
+    data = offline_svc.sheets.values.return_value.batchUpdate.call_args.kwargs["body"]["data"]
+    assert [d["range"] for d in data] == ["'Houses'!A6:E6"], "Should not overwrite the row below the homes"
+    assert offline_svc.layout().rows[4] == 4
+
+
+def test_batch(offline_svc):
+    sheets = offline_svc.sheets
+    with offline_svc.batch():
+        offline_svc.upsert_homes([{"Code #": i, "Price": i, "Street": "", "City": "Perwez"} for i in (1, 4, 5)])
+        offline_svc.set_home_filter([2, 3])
+        assert not sheets.batchUpdate.called, "Should wait for the end of the batch"
+    requests = sheets.batchUpdate.call_args.kwargs["body"]["requests"]
+    assert [next(iter(r)) for r in requests] == ["appendDimension", "updateDimensionProperties", "setBasicFilter"]
+    assert requests[0]["appendDimension"]["length"] == 3
+    data = sheets.values.return_value.batchUpdate.call_args.kwargs["body"]["data"]
+    assert [d["range"] for d in data] == ["'Houses'!A6:E7", "'Houses'!A2:B2"]
+    assert sheets.batchUpdate.call_count == sheets.values.return_value.batchUpdate.call_count == 1
+
+
+def test_sync_new_filter(offline_svc, memory_cache):
+    memory_cache.add_homes([({"id": 4, "property_type": "Home", "city": "", "postal_code": "", "price": 1},
+                             {"Code #": 4, "Price": 1, "Street": "", "City": "Perwez"})])
+    memory_cache.set_geocoded(4)
+    with patch("localize_be.tasks.sync.get_sheet", return_value=offline_svc):
+        assert sync_new.run([2, 3]) == 1
+    sheets = offline_svc.sheets
+    assert sheets.get.return_value.execute.call_count == 1
+    requests = sheets.batchUpdate.call_args.kwargs["body"]["requests"]
+    assert [next(iter(r)) for r in requests] == ["appendDimension", "updateDimensionProperties", "setBasicFilter"]
+    assert sheets.batchUpdate.call_count == sheets.values.return_value.batchUpdate.call_count == 1
+    assert memory_cache.get_homes_to_sync() == []
+
+
+def test_chunks():
+    items = [{"a": "x" * 10}] * 5
+    assert [len(c) for c in _chunks(items, max_bytes=40)] == [2, 2, 1]
+    assert list(_chunks([])) == []
+
+
+def test_column():
+    assert [_column(i) for i in (0, 25, 26, 51, 701)] == ["A", "Z", "AA", "AZ", "ZZ"]
@@ -149,11 +149,11 @@ def hide_rows(sheet, row_indices):
                 "fields": "hiddenByUser"
             }
         })
-        sheet.batchUpdate(
-            spreadsheetId=SPREADSHEET_ID,
-            body={
-                "requests": requests
-            }).execute()
+    sheet.batchUpdate(
+        spreadsheetId=SPREADSHEET_ID,
+        body={
+            "requests": requests
+        }).execute()
 
 
 def main(home_csv):